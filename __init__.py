@@ -0,0 +1,36 @@
+""" RS485 lines and modules
+    Public classes are available from the package itself: from rs485 import SocketLine, Adam4068.
+    Submodules are imported on first use of their names, so a tool talking to one module kind
+    doesn't pay for the rest: asyncio, pyserial, servers and simulators are loaded only when used.
+"""
+from importlib import import_module
+
+modules = {
+    "line": ("Timeout", "DeadlineExpired", "PersistentSocket", "ConnectionPool", "BufferOverflow", "LineBuffer", "Line", "SerialLine", "SocketLine", "DebugLine"),
+    "asyncline": ("AsyncLine", "AsyncSocketLine", "AsyncSerialLine"),
+    "adam": ("AdamError", "BadModuleType", "BadReply", "AdamCodec", "AdamModule", "Adam4068", "Adam4024", "Adam4017", "Adam4053"),
+    "piv": ("PivError", "BadPivPacket", "BadPivModuleType", "BadPivRelpy", "PivCodec", "PivDecoder", "Piv", "PivModule", "Kshd"),
+    "scheduler": ("LineScheduler",),
+    "retry": ("RttEstimator", "RetryPolicy"),
+    "registry": ("ModuleRegistry",),
+    "trace": ("LatencyHistogram", "ModuleStats", "Tracer"),
+    "reactor": ("LineReactor",),
+    "recorder": ("Recorder", "RecordFile"),
+    "motion": ("MotionMonitor", "KshdGroup", "Trajectory", "TrajectoryReport"),
+    "busd": ("BusExecutor", "BusServer", "BusClient", "RemoteAdam4068", "RemoteAdam4024", "RemoteAdam4017", "RemoteAdam4053", "RemotePiv"),
+    "shard": ("SharedRing", "ShardSupervisor"),
+    "sim": ("AdamEmulator", "KshdEmulator", "SimulatedBus", "SimulatedLine", "SimulatedGateway"),
+}
+exports = dict((name, module) for module, names in modules.items() for name in names)
+__all__ = sorted(exports)
+
+def __getattr__(name):
+    module = exports.get(name)
+    if module is None:
+        raise AttributeError("module %r has no attribute %r" % (__name__, name))
+    value = getattr(import_module("." + module, __name__), name)
+    globals()[name] = value
+    return value
+
+def __dir__():
+    return sorted(set(globals()) | set(exports))
@@ -1,5 +1,11 @@
-from line import Timeout
+from .line import Timeout, total_seconds, deadlineAfter
+from .scheduler import LineScheduler
+from .retry import RttEstimator
+import re
+from array import array
 from datetime import timedelta
+from threading import Lock
+from time import monotonic
 
 class AdamError(RuntimeError):
     pass
@@ -33,6 +39,97 @@ class BadReply(AdamError):
         return rv 
 
 
+class AdamCodec(object):
+    """ Request encoder and reply parser of one ADAM module address
+        Request frames (start character, address, command and CR) are built once per command
+        and cached. Values are formatted with bytes % after a cached #AA prefix.
+        Replies are validated by precompiled patterns, detailed checks run only to explain failures.
+        Data replies are parsed into numbers with one pattern per command type:
+        digital data of $AA6 into int and analog data of #AA into array of floats.
+        queryReplyLengths holds lengths of data following !AA in replies to known queries.
+    """
+    cacheSize = 256
+    queryReplyLengths = {"M": 4}
+    analogValue = rb"([+-][0-9]+(?:\.[0-9]*)?)"
+    analogReplies = {}
+    digitalReplies = {}
+    def __init__(self, address):
+        self.address = b"%02X" % address
+        self.__queries__ = {}
+        self.__writes__ = {}
+        self.__writePrefix__ = b"#" + self.address
+        self.__queryReply__ = re.compile(b"!" + self.address + b"(.*)", re.S)
+        self.__writeReply__ = re.compile(b">|!" + self.address + b"(.*)", re.S)
+    def query(self, command):
+        """Returns $AA<command> frame with CR for str command"""
+        frame = self.__queries__.get(command)
+        if frame is None:
+            frame = b"$" + self.address + bytes(command, "utf-8") + b"\r"
+            if len(self.__queries__) < AdamCodec.cacheSize:
+                self.__queries__[command] = frame
+        return frame
+    def write(self, data):
+        """Returns #AA<data> frame with CR for str data"""
+        frame = self.__writes__.get(data)
+        if frame is None:
+            frame = b"#" + self.address + bytes(data, "utf-8") + b"\r"
+            if len(self.__writes__) < AdamCodec.cacheSize:
+                self.__writes__[data] = frame
+        return frame
+    def format(self, template, values):
+        """Returns #AA<template % values> frame with CR"""
+        return self.__writePrefix__ + template % values + b"\r"
+    def queryPayload(self, frame, reply):
+        """Returns data of reply to query frame following !AA"""
+        match = self.__queryReply__.fullmatch(reply)
+        if match is not None:
+            return match.group(1)
+        request = frame[:-1]
+        if len(reply) < 3:
+            raise BadReply(request, reply, " reply is too short")
+        if reply[0:1] != b'!':
+            raise BadReply(request, reply, " reply should start with !")
+        raise BadReply(request, reply, " reply should begin with address of module: " + toString(self.address))
+    @staticmethod
+    def digitalData(request, reply, channelCount):
+        """Returns int bit mask of channels from !(data)00 reply to $AA6, bit n is channel n"""
+        digits = (channelCount + 3) // 4
+        pattern = AdamCodec.digitalReplies.get(digits)
+        if pattern is None:
+            pattern = AdamCodec.digitalReplies[digits] = re.compile(rb"!([0-9A-Fa-f]{%d})" % digits)
+        match = pattern.match(reply)
+        if match is None:
+            if reply[0:1] != b'!' or len(reply) < 1 + digits:
+                raise BadReply(request, reply, " reply should be !(data)00")
+            raise BadReply(request, reply, " data should be hexadecimal")
+        return int(match.group(1), 16)
+    @staticmethod
+    def analogData(request, reply, channelCount):
+        """Returns array of channelCount floats from >(data)(data)... reply to #AA in engineering units"""
+        pattern = AdamCodec.analogReplies.get(channelCount)
+        if pattern is None:
+            pattern = AdamCodec.analogReplies[channelCount] = re.compile(b">" + AdamCodec.analogValue * channelCount)
+        match = pattern.fullmatch(reply)
+        if match is None:
+            if reply[0:1] != b'>':
+                raise BadReply(request, reply, " reply should start with >")
+            raise BadReply(request, reply, " expected %d signed decimal values" % channelCount)
+        return array('d', map(float, match.groups()))
+    def checkWrite(self, frame, reply):
+        """Validates acknowledgement of write frame"""
+        match = self.__writeReply__.fullmatch(reply)
+        if match is not None:
+            echo = match.group(1)
+            if echo and echo != frame[3:-1]:
+                raise BadReply(frame[:-1], reply, " wrong data in reply")
+            return
+        request = frame[:-1]
+        if reply[0:1] == b'!':
+            raise BadReply(request, reply, " wrong address in reply")
+        elif reply[0:1] == b'?':
+            raise BadReply(request, reply, " malformed write request")
+        raise BadReply(request, reply, " unknown reply type")
+
 class AdamModule(object):
     def __init__(self, line, address):
         self.__line__ = line
@@ -41,59 +138,164 @@ class AdamModule(object):
         self.__addressNum__ = address
         self.__address__ = bytes("%02X" % address, "utf-8")
         assert(len(self.__address__) == 2) 
+        self.__codec__ = AdamCodec(address)
         self.timeout = timedelta(seconds=1)
-    def query(self, command):
-        command = bytes(command, "utf-8")
-        address = self.__address__
-        request = b"$" + address + command
-        self.__line__.lock.acquire()
-        try:
-            self.__line__.write(request + b"\r")
+        self.retryPolicy = None
+        self.rtt = RttEstimator()
+    def identify(self, priority=None):
+        """Returns module type reported by module"""
+        return self.query("M", priority)
+    def __probe__(self, registry, validate, accept):
+        """ Identifies module, accept(moduleType) should raise BadModuleType for unsupported types
+            Type known to registry is accepted without bus transaction and optionally validated in background.
+        """
+        cached = None
+        if registry is not None:
+            cached = registry.get(self.__line__, self.__addressNum__)
+        if cached is not None and "type" in cached:
+            accept(cached["type"])
+            if validate:
+                registry.validate(self.__line__, self.__addressNum__, lambda: accept(self.identify(LineScheduler.BACKGROUND)))
+            return
+        t = self.identify()
+        accept(t)
+        if registry is not None:
+            registry.update(self.__line__, self.__addressNum__, type=t)
+    def query(self, command, priority=None, queueTimeout=None, replyLength=None):
+        """ Sends $AA<command> and returns reply data following !AA
+            priority and queueTimeout are passed to Line.transact()
+            replyLength is length of reply data if known, it lets line read reply in bulk.
+            It defaults to AdamCodec.queryReplyLengths entry of command.
+        """
+        codec = self.__codec__
+        frame = codec.query(command)
+        if replyLength is None:
+            replyLength = AdamCodec.queryReplyLengths.get(command)
+        expected = None if replyLength is None else replyLength + 4
+        def transaction(line):
+            return self.__exchange__(line, frame, lambda reply: codec.queryPayload(frame, reply),
+                                     "Timeout while waiting for reply for query: ", expected=expected)
+        return self.__line__.transact(transaction, priority, queueTimeout, self.__addressNum__).decode("utf-8")
+    def rawQuery(self, request, parse, priority=None, queueTimeout=None, replyLength=None):
+        """ Sends request (without CR) and returns parse(request, reply), for replies without address
+            replyLength is length of reply without CR if known.
+        """
+        request = bytes(request)
+        frame = request + b"\r"
+        expected = None if replyLength is None else replyLength + 1
+        def transaction(line):
+            return self.__exchange__(line, frame, lambda reply: parse(request, reply),
+                                     "Timeout while waiting for reply for query: ", expected=expected)
+        return self.__line__.transact(transaction, priority, queueTimeout, self.__addressNum__)
+    def __exchange__(self, line, frame, parse, message, idempotent=True, expected=None):
+        """ Sends frame and returns parsed reply, retrying as retryPolicy allows
+            expected is reply length including CR if known, it lets line read reply in bulk.
+        """
+        def attempt(timeout):
+            deadline = deadlineAfter(timeout)
             try:
-                line = self.__line__.readline(self.timeout)
+                line.writeUntil(frame, deadline)
+                reply = line.readlineUntil(deadline, b'\r', expected)
             except Timeout as e:
-                raise Timeout("Timeout while waiting for reply for query: " + request.decode("utf-8")) from e
-        finally:
-            self.__line__.lock.release()
-            
-        if len(line) < 3:
-            raise BadReply(request, line, " reply is too short")
-        if line[0:1] != b'!':
-            raise BadReply(request, line, " reply should start with !")
-        if line[1:3] != address:
-            raise BadReply(request, line, " reply should begin with address of module: " + address)
-        return line[3:].decode("utf-8")
-    def write(self, data):
-        address = self.__address__
-        data = bytes(data, "utf-8")
-        request = b"#" + address + data
-        self.__line__.lock.acquire()
+                raise Timeout(message + bytes(frame[:-1]).decode("utf-8")) from e
+            return parse(reply)
+        if self.retryPolicy is None:
+            return attempt(self.timeout)
+        return self.retryPolicy.run(line, self.rtt, self.timeout, attempt, idempotent, (Timeout, AdamError))
+    async def queryAsync(self, command):
+        """ Same as query() for modules attached to asyncline.AsyncLine """
+        frame = self.__codec__.query(command)
+        async with self.__line__.lock:
+            await self.__line__.write(frame)
+            try:
+                line = await self.__line__.readline(self.timeout)
+            except Timeout as e:
+                raise Timeout("Timeout while waiting for reply for query: " + frame[:-1].decode("utf-8")) from e
+        return self.__codec__.queryPayload(frame, line).decode("utf-8")
+    pollDelimiter = b'\r'
+    def pollRequest(self, command):
+        """ Returns request frame and reply key of query for Line.pollMany() """
+        return self.__codec__.query(command), self.__addressNum__
+    def pollMatch(self, line):
+        """ Returns address and payload of any ADAM reply line """
         try:
-            self.__line__.write(request + b"\r")
-            line = self.__line__.readline(self.timeout)
-        except Timeout as e:
-            raise Timeout("Error while waiting for reply to write request: " + request.decode("utf-8")) from e
-        finally:
-            self.__line__.lock.release()
-        if line == b">":
-            return
-        elif line[0:1] == b'!':
-            if line[1:3] != address:
-                raise BadReply(request, line, " wrong address in reply")
-            if len(line) == 3:
-                return
-            if line[3:] != data:
-                raise BadReply(request, line, " wrong data in reply")
-        elif line[0:1] == b'?':
-            raise BadReply(request, line, " malformed write request")
-        raise BadReply(request, line, " unknown reply type")
+            return int(line[1:3], 16), line
+        except ValueError:
+            raise AdamError("Reply has no address: " + toString(line)) from None
+    def pollReply(self, command, line):
+        codec = self.__codec__
+        return codec.queryPayload(codec.query(command), line).decode("utf-8")
+    def write(self, data, priority=None, queueTimeout=None, idempotent=True):
+        """ Sends #AA<data> and validates acknowledgement
+            Output settings are absolute, so writes are retried unless idempotent is False.
+        """
+        codec = self.__codec__
+        frame = codec.write(data)
+        def transaction(line):
+            self.__exchange__(line, frame, lambda reply: codec.checkWrite(frame, reply),
+                              "Error while waiting for reply to write request: ", idempotent, 2)
+        self.__line__.transact(transaction, priority, queueTimeout, self.__addressNum__)
+    def writeFormat(self, template, values, priority=None, queueTimeout=None, idempotent=True):
+        """ Same as write() for data given as bytes template and tuple of values """
+        codec = self.__codec__
+        frame = codec.format(template, values)
+        def transaction(line):
+            self.__exchange__(line, frame, lambda reply: codec.checkWrite(frame, reply),
+                              "Error while waiting for reply to write request: ", idempotent, 2)
+        self.__line__.transact(transaction, priority, queueTimeout, self.__addressNum__)
+    async def writeAsync(self, data):
+        """ Same as write() for modules attached to asyncline.AsyncLine """
+        frame = self.__codec__.write(data)
+        async with self.__line__.lock:
+            try:
+                await self.__line__.write(frame)
+                line = await self.__line__.readline(self.timeout)
+            except Timeout as e:
+                raise Timeout("Error while waiting for reply to write request: " + frame[:-1].decode("utf-8")) from e
+        self.__codec__.checkWrite(frame, line)
                  
 
+class ShadowOutputs(object):
+    """ Last values written to module outputs, None for unknown
+        Lets output modules skip writes of unchanged values. With resyncInterval set,
+        whole image is rewritten periodically so it can't drift from hardware.
+    """
+    def __init__(self, count, resyncInterval=None):
+        self.values = [None] * count
+        self.resyncInterval = resyncInterval
+        self.suppressed = 0
+        self.__synced__ = monotonic()
+    def resyncDue(self):
+        if self.resyncInterval is None:
+            return False
+        return monotonic() - self.__synced__ >= total_seconds(self.resyncInterval)
+    def synced(self):
+        self.__synced__ = monotonic()
+    def changes(self, values):
+        """Returns {channel: value} of values differing from image, counts suppressed ones"""
+        rv = {}
+        for channel, value in values.items():
+            if self.values[channel] == value:
+                self.suppressed += 1
+            else:
+                rv[channel] = value
+        return rv
+    def invalidate(self, channel=None):
+        if channel is None:
+            self.values = [None] * len(self.values)
+        else:
+            self.values[channel] = None
+
 class Adam4068(AdamModule):
-    """ 8-channel relay """
-    def __init__(self, line, address):
+    """ 8-channel relay
+        Pass registry.ModuleRegistry to skip identification of known modules.
+        Relay states are kept in shadow image, writes of unchanged states are skipped.
+    """
+    def __init__(self, line, address, registry=None, validate=True):
         AdamModule.__init__(self, line, address)
-        t = self.query("M")
+        self.__probe__(registry, validate, self.__accept__)
+        self.shadow = ShadowOutputs(self.channelCount)
+    def __accept__(self, t):
         if t == "4068":
             self.channelCount=8
         elif t == "4060":
@@ -104,18 +306,65 @@ class Adam4068(AdamModule):
         """ Switches channel to given position """ 
         if channel < 0 or channel > 7: 
             raise ValueError("Channel should be in [0..7]")
-        if enabled:
-            enabled = 1
-        else:
-            enabled = 0
-        data = "1%X0%X" % (channel, enabled)
-        self.write(data)
+        self.setChannels({channel: enabled})
+    def setChannels(self, states):
+        """ Switches several channels
+            states is a sequence of all channel states or a dict {channel: state}.
+            Multiple changes are combined into single all-channel write when all states are known.
+        """
+        if not isinstance(states, dict):
+            states = dict(enumerate(states))
+        states = dict((int(channel), bool(state)) for channel, state in states.items())
+        for channel in states:
+            if channel < 0 or channel >= self.channelCount:
+                raise ValueError("Channel should be in [0..%d]" % (self.channelCount - 1))
+        if self.shadow.resyncDue():
+            image = list(self.shadow.values)
+            for channel, state in states.items():
+                image[channel] = state
+            if None not in image:
+                return self.__writeAll__(image)
+        changes = self.shadow.changes(states)
+        if not changes:
+            return
+        image = list(self.shadow.values)
+        for channel, state in changes.items():
+            image[channel] = state
+        if len(changes) > 1 and None not in image:
+            return self.__writeAll__(image)
+        for channel, state in changes.items():
+            self.shadow.values[channel] = None
+            self.writeFormat(b"1%X0%X", (channel, int(state)))
+            self.shadow.values[channel] = state
+    def __writeAll__(self, image):
+        mask = 0
+        for channel, state in enumerate(image):
+            if state:
+                mask |= 1 << channel
+        self.shadow.invalidate()
+        self.writeFormat(b"00%02X", (mask,))
+        self.shadow.values = list(image)
+        self.shadow.synced()
+    def flush(self):
+        """ Rewrites known relay states to module """
+        image = self.shadow.values
+        if None not in image:
+            return self.__writeAll__(image)
+        for channel, state in enumerate(list(image)):
+            if state is not None:
+                self.writeFormat(b"1%X0%X", (channel, int(state)))
+        self.shadow.synced()
     
 class Adam4024(AdamModule):
-    """ 4-channel analog output module """
-    def __init__(self, line, address):
+    """ 4-channel analog output module
+        Pass registry.ModuleRegistry to skip identification of known modules.
+        Output values are kept in shadow image, writes of unchanged values are skipped.
+    """
+    def __init__(self, line, address, registry=None, validate=True):
         AdamModule.__init__(self, line, address)  
-        t = self.query("M")
+        self.__probe__(registry, validate, self.__accept__)
+        self.shadow = ShadowOutputs(4)
+    def __accept__(self, t):
         if t != "4024":
             raise BadModuleType("4024", t)
     def __validateChannel__(self, channel):
@@ -125,11 +374,33 @@ class Adam4024(AdamModule):
         """ Sets channel output value in volts or miliampers
             Use setChannelOutputRange() to configure current/voltage mode.
         """
-        channel = int(channel)
-        self.__validateChannel__(channel)
-        value = float(value)
-        data = "C%X%+07.3f" % (channel, value)
-        self.write(data)
+        self.setChannels({channel: value})
+    def setChannels(self, values):
+        """ Sets several channels, values is a sequence of all channel values or a dict {channel: value} """
+        if not isinstance(values, dict):
+            values = dict(enumerate(values))
+        rounded = {}
+        for channel, value in values.items():
+            channel = int(channel)
+            self.__validateChannel__(channel)
+            rounded[channel] = round(float(value), 3)
+        if self.shadow.resyncDue():
+            for channel, value in enumerate(self.shadow.values):
+                if value is not None and channel not in rounded:
+                    rounded[channel] = value
+            self.shadow.synced()
+        else:
+            rounded = self.shadow.changes(rounded)
+        for channel, value in sorted(rounded.items()):
+            self.shadow.values[channel] = None
+            self.writeFormat(b"C%X%+07.3f", (channel, value))
+            self.shadow.values[channel] = value
+    def flush(self):
+        """ Rewrites known output values to module """
+        for channel, value in enumerate(list(self.shadow.values)):
+            if value is not None:
+                self.writeFormat(b"C%X%+07.3f", (channel, value))
+        self.shadow.synced()
     def setChannelOutputRange(self, channel, rangeMode):
         """ Allowed ranges:
         0 -   0 ~ 20 mA
@@ -141,9 +412,72 @@ class Adam4024(AdamModule):
         if not rangeMode in (0, 1, 2):
             raise ValueError("Invalid rangeMode: %d, range should be in [0,1,2]" % rangeMode)
         query = "7C%dR3%d" % (channel, rangeMode)
-        reply = self.query(query)
+        self.shadow.invalidate(channel)
+        reply = self.query(query, replyLength=0)
         if reply != "":
             raise BadReply(query, reply, " reply should be empty string")
-        
-        
-    
+
+
+class AdamInputModule(AdamModule):
+    """ Input module read with a single query for all channels
+        With ttl (timedelta) set, readings are shared by callers until they get older than ttl.
+    """
+    def __init__(self, line, address, registry=None, validate=True, ttl=None):
+        AdamModule.__init__(self, line, address)
+        self.__probe__(registry, validate, self.__accept__)
+        self.ttl = ttl
+        self.__cache__ = None
+        self.__cachedAt__ = None
+        self.__cacheLock__ = Lock()
+    def __accept__(self, t):
+        if t not in self.types:
+            raise BadModuleType("/".join(self.types), t)
+    def readAll(self):
+        """Reads all channels from module bypassing cache"""
+        raise NotImplementedError
+    def read(self):
+        """Returns array of all channel values, cached for ttl"""
+        if self.ttl is None:
+            return self.readAll()
+        with self.__cacheLock__:
+            now = monotonic()
+            if self.__cache__ is None or now - self.__cachedAt__ >= total_seconds(self.ttl):
+                self.__cache__ = self.readAll()
+                self.__cachedAt__ = now
+            return self.__cache__
+    def invalidate(self):
+        with self.__cacheLock__:
+            self.__cache__ = None
+    def channel(self, channel):
+        return self.read()[channel]
+
+class AdamAnalogInput(AdamInputModule):
+    """ Analog input module in engineering units data format
+        All channels are read with #AA block query, reply is >(data)(data)... with 7 characters per value.
+    """
+    types = ()
+    channelCount = 8
+    def __parse__(self, request, reply):
+        return AdamCodec.analogData(request, reply, self.channelCount)
+    def readAll(self):
+        return self.rawQuery(b"#" + self.__address__, self.__parse__, replyLength=1 + 7 * self.channelCount)
+
+class Adam4017(AdamAnalogInput):
+    """ 8-channel analog input """
+    types = ("4017", "4017P")
+
+class AdamDigitalInput(AdamInputModule):
+    """ Digital input module
+        All channels are read with $AA6 query, reply is !(data)00, bit n of data is channel n
+    """
+    types = ()
+    channelCount = 16
+    def __parse__(self, request, reply):
+        data = AdamCodec.digitalData(request, reply, self.channelCount)
+        return array('B', ((data >> channel) & 1 for channel in range(self.channelCount)))
+    def readAll(self):
+        return self.rawQuery(b"$" + self.__address__ + b"6", self.__parse__, replyLength=3 + (self.channelCount + 3) // 4)
+
+class Adam4053(AdamDigitalInput):
+    """ 16-channel digital input """
+    types = ("4053", "4051")
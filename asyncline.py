@@ -0,0 +1,91 @@
+import asyncio
+import os
+from datetime import timedelta
+from .line import LineBuffer, Timeout, total_seconds
+
+class AsyncLine(object):
+    """Abstract RS485 line driven by asyncio event loop
+       One event loop may serve any number of lines without dedicated threads.
+    """
+    def __init__(self, highWater=65536):
+        self.__buffer__ = LineBuffer(min(4096, highWater), highWater)
+        self.lock = asyncio.Lock()
+    async def write(self, data):
+        raise NotImplementedError
+    async def readSome(self):
+        """Waits until at least one byte is read into buffer."""
+        raise NotImplementedError
+    async def __readline__(self, delimiter):
+        while True:
+            line = self.__buffer__.readline(delimiter)
+            if line:
+                return line
+            if line is None:
+                await self.readSome()
+    async def readline(self, timeout, delimiter=b'\r'):
+        assert(isinstance(timeout, timedelta))
+        try:
+            return await asyncio.wait_for(self.__readline__(delimiter), total_seconds(timeout))
+        except asyncio.TimeoutError:
+            raise Timeout("Line read timeout. Data read so far: " + str(bytes(self.__buffer__))) from None
+
+class AsyncSocketLine(AsyncLine):
+    """Makes use of TCP/IP to RS485 converters through asyncio streams"""
+    def __init__(self, reader, writer, highWater=65536):
+        AsyncLine.__init__(self, highWater)
+        self.__reader__ = reader
+        self.__writer__ = writer
+    @staticmethod
+    async def connect(host, port):
+        reader, writer = await asyncio.open_connection(host, port)
+        return AsyncSocketLine(reader, writer)
+    async def readSome(self):
+        data = await self.__reader__.read(4096)
+        if not data:
+            raise ConnectionResetError("Gateway closed connection")
+        self.__buffer__.append(data)
+    async def write(self, data):
+        self.__writer__.write(data)
+        await self.__writer__.drain()
+    def close(self):
+        self.__writer__.close()
+
+class AsyncSerialLine(AsyncLine):
+    """Makes use of RS232 to RS485 converters through non-blocking file descriptor
+       serial argument should be an opened serial.Serial instance (POSIX only)
+    """
+    def __init__(self, serial, highWater=65536):
+        AsyncLine.__init__(self, highWater)
+        self.__serial__ = serial
+        self.__fd__ = serial.fileno()
+        os.set_blocking(self.__fd__, False)
+    async def __waitFd__(self, add, remove):
+        loop = asyncio.get_running_loop()
+        ready = loop.create_future()
+        add(self.__fd__, lambda: ready.done() or ready.set_result(None))
+        try:
+            await ready
+        finally:
+            remove(self.__fd__)
+    async def readSome(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            try:
+                count = os.readv(self.__fd__, [self.__buffer__.reserve()])
+            except BlockingIOError:
+                count = 0
+            if count:
+                self.__buffer__.commit(count)
+                return
+            await self.__waitFd__(loop.add_reader, loop.remove_reader)
+    async def write(self, data):
+        loop = asyncio.get_running_loop()
+        data = memoryview(bytes(data))
+        while data:
+            try:
+                written = os.write(self.__fd__, data)
+            except BlockingIOError:
+                written = 0
+            data = data[written:]
+            if data:
+                await self.__waitFd__(loop.add_writer, loop.remove_writer)
@@ -0,0 +1,498 @@
+""" Performance benchmarks
+    Run as: python -m rs485.bench [name ...]
+    Without arguments all benchmarks are run.
+"""
+import os
+import re
+import subprocess
+import sys
+import tracemalloc
+from multiprocessing import cpu_count
+from threading import Thread
+from datetime import datetime, timedelta
+from array import array
+from itertools import cycle
+from socket import create_connection, create_server
+from tempfile import mkdtemp
+from time import perf_counter, perf_counter_ns, time
+from .line import Line, SocketLine, PersistentSocket, Timeout
+from .piv import Piv, PivCodec, PivDecoder, BadPivPacket, Kshd
+from .adam import AdamModule, AdamCodec, Adam4068, Adam4024
+from .retry import RetryPolicy
+from .trace import LatencyHistogram
+from .reactor import LineReactor
+from .recorder import Recorder, RecordFile
+from .motion import MotionMonitor, Trajectory
+from .busd import RemotePiv
+from .shard import ShardSupervisor
+from .sim import SimulatedBus, SimulatedLine, SimulatedGateway, AdamEmulator, KshdEmulator
+
+def rate(action, count):
+    """Returns number of action() calls per second"""
+    started = perf_counter()
+    for i in range(count):
+        action()
+    return count / (perf_counter() - started)
+
+def report(name, value, unit):
+    print("%-40s %14.1f %s" % (name, value, unit))
+
+def legacyCalcControl(data):
+    rv = 0
+    for b in data:
+        rv ^= b
+    return rv
+
+def legacyPivEncode(address, data):
+    """Per-byte PIV encoder as it was before PivCodec"""
+    body = bytearray()
+    body.append(address)
+    body += data
+    body.append(legacyCalcControl(body))
+    buffer = bytearray()
+    buffer.append(Piv.cstart)
+    for b in body:
+        assert(b >=0 and b < 256)
+        if b in Piv.escapedSymbols:
+            buffer.append(Piv.cshift)
+            buffer.append(b - Piv.cstart)
+        else:
+            buffer.append(b)
+    buffer.append(Piv.cstop)
+    return buffer
+
+def legacyPivDecode(address, data):
+    """Per-byte PIV decoder as it was before PivCodec"""
+    if len(data) < 2:
+        raise BadPivPacket(("Piv packet is too short", data))
+    converted = bytearray()
+    shifted = False
+    for b in data:
+        if b == Piv.cshift:
+            if shifted:
+                raise BadPivPacket(("Invalid shift", data))
+            shifted = True
+            continue
+        if shifted:
+            if b + Piv.cstart > 255 or b in Piv.escapedSymbols:
+                raise BadPivPacket(("Invalid shift", data))
+            b += Piv.cstart
+        shifted = False
+        assert(b >=0 and b < 256)
+        converted.append(b)
+    body = converted[0:-1]
+    if legacyCalcControl(body) != converted[-1]:
+        raise BadPivPacket(("Bad control sum", converted))
+    if body[0] != address:
+        raise BadPivPacket(("Invalid address", data))
+    return body[1:]
+
+def importTime(statement):
+    """ Returns microseconds spent importing modules by statement in a fresh interpreter
+        and names of top level modules it imported, measured with python -X importtime
+    """
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(filter(None, [root, os.environ.get("PYTHONPATH")])))
+    baseline = subprocess.run([sys.executable, "-X", "importtime", "-c", "pass"], env=env, capture_output=True, text=True).stderr
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", statement], env=env, capture_output=True, text=True, check=True).stderr
+    def imported(log):
+        rv = {}
+        for entry in log.splitlines():
+            if not entry.startswith("import time:") or "cumulative" in entry:
+                continue
+            fields = entry[len("import time:"):].split("|")
+            name = fields[2][1:].rstrip()
+            if not name.startswith(" "):
+                rv[name] = int(fields[1])
+        return rv
+    before, after = imported(baseline), imported(result)
+    added = [name for name in after if name not in before]
+    return sum(after[name] for name in added), added
+
+def benchImports():
+    """ Cold start cost of package entry points, fails if heavy imports creep into core modules """
+    package = __package__ or "rs485"
+    offenders = []
+    for statement in ("import %s", "from %s import SocketLine", "from %s import Adam4068",
+                      "from %s import Kshd", "from %s import Adam4068, Kshd, SocketLine"):
+        statement = statement % package
+        us, added = importTime(statement)
+        heavy = [name for name in ("asyncio", "unittest", "serial", "concurrent") if name in added]
+        report(statement, us / 1000., "ms" + (" (imports %s)" % ", ".join(heavy) if heavy else ""))
+        if heavy:
+            offenders.append("%s imports %s" % (statement, ", ".join(heavy)))
+    if offenders:
+        raise RuntimeError("Heavy imports in core entry points: " + "; ".join(offenders))
+
+def benchPivCodec(count=20000):
+    """ Frames per second of PIV encoding and decoding, legacy loops against PivCodec
+        Fails if codec decodes any frame slower than legacy loop, best of three runs is compared.
+    """
+    payloads = [b'\x03', b'\x11' + bytes(range(0xA8, 0xB0)), b'\x07\x03\xe8\x17\x70\x27\x10']
+    slower = []
+    for payload in payloads:
+        name = "piv %d byte payload" % len(payload)
+        frame = PivCodec.encode(5, payload)
+        assert(frame == legacyPivEncode(5, payload))
+        received = frame[1:-1]
+        assert(legacyPivDecode(5, received) == PivCodec.decodeFrame(received)[1:])
+        report(name + " encode legacy", rate(lambda: legacyPivEncode(5, payload), count), "frames/s")
+        report(name + " encode codec", rate(lambda: PivCodec.encode(5, payload), count), "frames/s")
+        legacy = max(rate(lambda: legacyPivDecode(5, received), count) for i in range(3))
+        codec = max(rate(lambda: PivCodec.decodeFrame(received), count) for i in range(3))
+        report(name + " decode legacy", legacy, "frames/s")
+        report(name + " decode codec", codec, "frames/s")
+        if codec < legacy:
+            slower.append(name)
+    stream = b"".join(PivCodec.encode(address, payload) for address in range(16) for payload in payloads)
+    frames = 16 * len(payloads)
+    decoder = PivDecoder()
+    def decodeStream():
+        for i in range(0, len(stream), 64):
+            decoder.feed(stream[i:i + 64])
+            for frame in decoder:
+                pass
+    report("piv streaming decoder, 64 byte chunks", rate(decodeStream, count // frames) * frames, "frames/s")
+    if slower:
+        raise RuntimeError("PivCodec decodes slower than legacy loop: " + ", ".join(slower))
+
+def legacyTryUntilTimeout(action, timeout):
+    """datetime based retry loop as it was before monotonic deadlines"""
+    assert(isinstance(timeout, timedelta))
+    until = datetime.now() + timeout
+    while True:
+        rv = action(timeout)
+        if rv:
+            return rv
+        timeout = until - datetime.now()
+        if timeout < timedelta(0):
+            return rv
+
+def legacyReadline(line, timeout, delimiter=b'\r'):
+    """Line.readline() as it was before monotonic deadlines"""
+    assert(isinstance(timeout, timedelta))
+    def tryReadLine(timeout):
+        rv = line.__buffer__.readline(delimiter)
+        if rv:
+            return rv
+        line.readWithTimeout(timeout)
+        return line.__buffer__.readline(delimiter)
+    rv = legacyTryUntilTimeout(tryReadLine, timeout)
+    if not rv:
+        raise Timeout("Line read timeout")
+    return rv
+
+class TrickleLine(Line):
+    """ Replies to every write with a fixed reply delivered one byte per read, as slow serial lines do """
+    def __init__(self, reply):
+        Line.__init__(self)
+        self.reply = reply
+        self.__pending__ = b""
+    def write(self, data):
+        self.__pending__ = self.reply
+    def readWithTimeout(self, timeout):
+        assert(isinstance(timeout, timedelta))
+        self.readUntil(0)
+    def readUntil(self, deadline):
+        self.__buffer__.append(self.__pending__[0:1])
+        self.__pending__ = self.__pending__[1:]
+
+def droppingGateway(replies):
+    """ Listens on localhost, answers every request with an ADAM 4068 identity and drops each connection after replies answers """
+    server = create_server(("127.0.0.1", 0))
+    def serve():
+        while True:
+            try:
+                connection = server.accept()[0]
+            except OSError:
+                return
+            with connection:
+                for i in range(replies):
+                    if not connection.recv(4096):
+                        break
+                    connection.sendall(b"!014068\r")
+    Thread(target=serve, name="DroppingGateway", daemon=True).start()
+    return server
+
+def benchReactor(count=1000, replies=10):
+    """ Queries per second of a reactor driven line whose gateway drops connection every few replies
+        Fails if reactor stops delivering replies after a reconnect. A request racing with the drop
+        is lost like on a real gateway, so queries are retried.
+    """
+    server = droppingGateway(replies)
+    reactor = LineReactor()
+    try:
+        sock = PersistentSocket(server.getsockname(), minBackoff=0., maxBackoff=0.)
+        line = SocketLine(sock)
+        reactor.attach(line)
+        module = AdamModule(line, 1)
+        module.timeout = timedelta(milliseconds=100)
+        module.retryPolicy = RetryPolicy()
+        def query():
+            if module.query("M") != "4068":
+                raise RuntimeError("Unexpected reply")
+        report("query, reconnect every %d replies" % replies, rate(query, count), "queries/s")
+        if sock.reconnects < count // replies - 1:
+            raise RuntimeError("Expected %d reconnects, got %d" % (count // replies - 1, sock.reconnects))
+    finally:
+        reactor.close()
+        server.close()
+
+def benchTimeouts(count=20000):
+    """ CPU time per transaction spent in read loops, datetime against monotonic_ns deadlines """
+    line = TrickleLine(b"!014068\r")
+    timeout = timedelta(seconds=1)
+    def legacy():
+        line.write(b"$01M\r")
+        legacyReadline(line, timeout)
+    def current():
+        line.write(b"$01M\r")
+        line.readline(timeout)
+    report("8 byte reply, legacy datetime loop", 1e6 / rate(legacy, count), "us/transaction")
+    report("8 byte reply, monotonic deadline", 1e6 / rate(current, count), "us/transaction")
+    module = AdamModule(line, 1)
+    report("AdamModule.query()", 1e6 / rate(lambda: module.query("M"), count), "us/transaction")
+
+class InstantLine(Line):
+    """Replies to every write with reply(request) available at once"""
+    def __init__(self, reply):
+        Line.__init__(self)
+        self.reply = reply
+    def write(self, data):
+        self.__buffer__.append(self.reply(bytes(data)))
+    def readWithTimeout(self, timeout):
+        pass
+    def readUntil(self, deadline):
+        pass
+
+def legacyAdamQuery(address, command, reply):
+    """ADAM query request building and reply checks as they were before AdamCodec"""
+    request = b"$" + address + bytes(command, "utf-8")
+    frame = request + b"\r"
+    if len(reply) < 3 or reply[0:1] != b'!' or reply[1:3] != address:
+        raise ValueError(reply)
+    return frame, reply[3:].decode("utf-8")
+
+def legacyAdamWrite(address, channel, value, reply):
+    """Adam4024 output request formatting and reply checks as they were before AdamCodec"""
+    data = bytes("C%X%s" % (channel, "%+07.3f" % float(value)), "utf-8")
+    request = b"#" + address + data
+    frame = request + b"\r"
+    if reply != b">" and (reply[0:1] != b'!' or reply[1:3] != address or (len(reply) > 3 and reply[3:] != data)):
+        raise ValueError(reply)
+    return frame
+
+legacyAnalogValue = re.compile(rb"[+-][0-9]+(?:\.[0-9]*)?")
+
+def legacyAdamAnalogRead(reply, count):
+    """Analog input reply parsing as it was before AdamCodec patterns, findall() and count check"""
+    if reply[0:1] != b'>':
+        raise ValueError(reply)
+    values = array('d', map(float, legacyAnalogValue.findall(reply, 1)))
+    if len(values) != count:
+        raise ValueError(reply)
+    return values
+
+def benchAdamCodec(count=100000):
+    """ Encode and decode cost per ADAM transaction, per call formatting against AdamCodec """
+    codec = AdamCodec(1)
+    report("query encode+decode, legacy", 1e9 / rate(lambda: legacyAdamQuery(b"01", "M", b"!014068"), count), "ns/transaction")
+    report("query encode+decode, AdamCodec", 1e9 / rate(lambda: codec.queryPayload(codec.query("M"), b"!014068").decode("utf-8"), count), "ns/transaction")
+    report("4024 write encode+check, legacy", 1e9 / rate(lambda: legacyAdamWrite(b"01", 2, 4.25, b">"), count), "ns/transaction")
+    report("4024 write encode+check, AdamCodec", 1e9 / rate(lambda: codec.checkWrite(codec.format(b"C%X%+07.3f", (2, 4.25)), b">"), count), "ns/transaction")
+    reply = b">" + b"".join(b"%+07.3f" % (i * 1.25) for i in range(8))
+    assert(legacyAdamAnalogRead(reply, 8) == AdamCodec.analogData(b"#01", reply, 8))
+    report("4017 read decode, legacy", 1e9 / rate(lambda: legacyAdamAnalogRead(reply, 8), count), "ns/transaction")
+    report("4017 read decode, AdamCodec", 1e9 / rate(lambda: AdamCodec.analogData(b"#01", reply, 8), count), "ns/transaction")
+    module = AdamModule(InstantLine(lambda request: b"!014068\r"), 1)
+    report("AdamModule.query() on instant line", 1e6 / rate(lambda: module.query("M"), count // 10), "us/transaction")
+    module = Adam4024(InstantLine(lambda request: b">\r" if request[0:1] == b"#" else b"!014024\r"), 1)
+    values = cycle([{2: 0.}, {2: 0.001}])
+    report("Adam4024.setChannels() on instant line", 1e6 / rate(lambda: module.setChannels(next(values)), count // 10), "us/transaction")
+
+def benchTrajectory(segments=10):
+    """ Segment boundary gaps of multi-segment moves on simulated bus: go and wait against Trajectory """
+    path = [(200 * (-1) ** i, 100) for i in range(segments)]
+    kshd = Kshd(Piv(SimulatedLine(SimulatedBus([KshdEmulator(3)]))), 3)
+    planned = sum(abs(steps) * stepTime for steps, stepTime in path) / 1e6
+    def sequential(wait):
+        started = perf_counter()
+        for steps, stepTime in path:
+            kshd.goWithSpeed(steps, stepTime)
+            wait()
+        return perf_counter() - started
+    report("planned", planned * 1000, "ms")
+    elapsed = sequential(kshd.waitReady)
+    report("goWithSpeed and waitReady()", elapsed * 1000, "ms, %.2f ms/gap" % ((elapsed - planned) * 1000 / segments))
+    monitor = MotionMonitor(minInterval=timedelta(milliseconds=1))
+    elapsed = sequential(lambda: kshd.waitReady(monitor))
+    monitor.close()
+    report("goWithSpeed and MotionMonitor", elapsed * 1000, "ms, %.2f ms/gap" % ((elapsed - planned) * 1000 / segments))
+    result = Trajectory(kshd, path).run()
+    gaps = result.gaps()
+    report("Trajectory.run()", result.achievedTotal() * 1000, "ms, %.2f ms/gap, %d polls" % (sum(gaps) * 1000 / len(gaps), result.polls))
+
+def shardLine():
+    """Simulated Kshd line fast enough for protocol processing to dominate, picklable line factory"""
+    return SimulatedLine(SimulatedBus([KshdEmulator(3)], baudrate=10 ** 9, latency=timedelta(0)))
+
+def benchShards(lines=8, count=500):
+    """ Kshd status transactions per second of lines served by a ShardSupervisor against number of workers """
+    print("%d CPUs, %d lines, %d transactions per line" % (cpu_count(), lines, count))
+    names = ["line%d" % i for i in range(lines)]
+    for workers in (1, 2, 4, 8):
+        if workers > lines:
+            break
+        supervisor = ShardSupervisor(dict((name, shardLine) for name in names), workers)
+        try:
+            axes = [Kshd(RemotePiv(supervisor.line(name)), 3, validate=False) for name in names]
+            def run(kshd):
+                for i in range(count):
+                    kshd.status()
+            threads = [Thread(target=run, args=(kshd,)) for kshd in axes]
+            started = perf_counter()
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            report("%d workers" % workers, lines * count / (perf_counter() - started), "tx/s")
+        finally:
+            supervisor.close()
+
+def reportTransactions(name, action, count):
+    """ Runs action() count times, reports transactions per second and latency percentiles """
+    histogram = LatencyHistogram()
+    failures = 0
+    started = perf_counter()
+    for i in range(count):
+        t = perf_counter_ns()
+        try:
+            action(i)
+        except RuntimeError:
+            failures += 1
+        histogram.record(perf_counter_ns() - t)
+    tps = count / (perf_counter() - started)
+    print("%-40s %8.1f tx/s  p50 %7.3f ms  p99 %7.3f ms  failed %d" % (name, tps, histogram.percentile(50) / 1e6, histogram.percentile(99) / 1e6, failures))
+
+def benchSimulated(count=200):
+    """ Transactions per second and latency of module classes on simulated bus """
+    line = SimulatedLine(SimulatedBus([AdamEmulator(1, "4068")]))
+    module = Adam4068(line, 1)
+    reportTransactions("adam query 115200", lambda i: module.query("M"), count)
+    reportTransactions("adam relay write 115200", lambda i: module.setChannel(0, i % 2), count)
+    line = SimulatedLine(SimulatedBus([AdamEmulator(1, "4068")], baudrate=9600))
+    module = AdamModule(line, 1)
+    reportTransactions("adam query 9600", lambda i: module.query("M"), count // 4)
+    line = SimulatedLine(SimulatedBus([AdamEmulator(address, "4068") for address in range(8)]))
+    batch = [(AdamModule(line, address), "M") for address in range(8)]
+    reportTransactions("adam pollMany 8 modules 115200", lambda i: line.pollMany(batch), count)
+    line = SimulatedLine(SimulatedBus([KshdEmulator(3)]))
+    kshd = Kshd(Piv(line), 3)
+    reportTransactions("kshd status 115200", lambda i: kshd.status(), count)
+    bus = SimulatedBus([KshdEmulator(3)], jitter=timedelta(milliseconds=2), seed=1)
+    piv = Piv(SimulatedLine(bus))
+    piv.timeout = timedelta(milliseconds=50)
+    piv.retryPolicy = RetryPolicy()
+    kshd = Kshd(piv, 3)
+    bus.loss = bus.corruption = 0.01
+    reportTransactions("kshd status 1% loss, retries", lambda i: kshd.status(), count)
+    gateway = SimulatedGateway(SimulatedBus([AdamEmulator(1, "4068")]))
+    try:
+        line = SocketLine(create_connection(gateway.address))
+        module = AdamModule(line, 1)
+        reportTransactions("adam query via tcp gateway", lambda i: module.query("M"), count)
+    finally:
+        gateway.close()
+
+def allocated(action):
+    """Returns bytes allocated by action() and still held after it"""
+    tracemalloc.start()
+    try:
+        before = tracemalloc.get_traced_memory()[0]
+        held = action()
+        return tracemalloc.get_traced_memory()[0] - before
+    finally:
+        tracemalloc.stop()
+
+class LegacyStatus(object):
+    """Kshd.Status as it was before int-backed statuses"""
+    def __init__(self, b):
+        b = int(b)
+        self.__b__ = b
+        self.ready = b & 1
+        self.moving = b & 2
+        self.atMinus = b & 4
+        self.atPlus = b & 8
+        self.atZero = b & 16
+        self.exactSpeed = b & 32
+
+def legacyCurrentToCode(value):
+    currentMap = Kshd.Configuration.currentMap
+    value = float(value)
+    if value == currentMap[len(currentMap)-1]:
+        return len(currentMap)-1
+    for code in range(len(currentMap)):
+        if currentMap[code] > value:
+            return code - 1
+
+def benchValues(count=100000):
+    """ Allocations and decoding speed of Kshd value types """
+    replies = [bytes([i & 0x3F]) for i in range(256)]
+    report("Status held, legacy object", allocated(lambda: [LegacyStatus(replies[i & 255][0]) for i in range(count)]) / count, "bytes/status")
+    report("Status held, Kshd.statuses", allocated(lambda: [Kshd.statuses[replies[i & 255][0]] for i in range(count)]) / count, "bytes/status")
+    report("status decode and .ready, legacy", rate(lambda: LegacyStatus(5).ready, count), "statuses/s")
+    report("status decode and .ready, Kshd.statuses", rate(lambda: Kshd.statuses[5].ready, count), "statuses/s")
+    report("currentToCode(1.5), legacy scan", rate(lambda: legacyCurrentToCode(1.5), count), "calls/s")
+    report("currentToCode(1.5), bisect", rate(lambda: Kshd.Configuration.currentToCode(1.5), count), "calls/s")
+    word = Kshd.Configuration(1.0, 0.5, 1.0).toWord()
+    report("Configuration held", allocated(lambda: [Kshd.Configuration.fromWord(word) for i in range(count // 10)]) / (count // 10), "bytes/object")
+    report("Configuration fromWord and toWord", rate(lambda: Kshd.Configuration.fromWord(word).toWord(), count), "round trips/s")
+    report("SpeedConf held", allocated(lambda: [Kshd.SpeedConf(100, 1000, 500) for i in range(count // 10)]) / (count // 10), "bytes/object")
+
+def benchRecorder(count=100000):
+    """ Memory per sample of Python object lists against Recorder columns, ingest and query rates """
+    def objects():
+        log = []
+        for i in range(count):
+            log.append((time(), 3, Kshd.Status(i & 0x3F)))
+        return log
+    recorder = Recorder()
+    def columns():
+        for i in range(count):
+            recorder.sample(3, int(Kshd.Status(i & 0x3F)))
+        return recorder
+    report("list of (time, address, Status)", allocated(objects) / count, "bytes/sample")
+    report("Recorder columns", allocated(columns) / count, "bytes/sample")
+    path = os.path.join(mkdtemp(), "bench.rec")
+    recorder = Recorder(path)
+    ids = [recorder.source("source%d" % i) for i in range(8)]
+    report("Recorder.sample() with flushes", rate(lambda: recorder.sample(ids[3], 1.5), count), "samples/s")
+    recorder.close()
+    records = RecordFile(path)
+    times = records.query()[0]
+    start, end = times[len(times) // 2], times[len(times) // 2 + 1000]
+    report("RecordFile.query() of 1000 samples", rate(lambda: records.query(start, end), 1000), "queries/s")
+    records.close()
+    os.remove(path)
+    os.remove(path + ".names")
+
+benchmarks = {
+    "adam": benchAdamCodec,
+    "import": benchImports,
+    "piv": benchPivCodec,
+    "reactor": benchReactor,
+    "recorder": benchRecorder,
+    "shard": benchShards,
+    "sim": benchSimulated,
+    "timeout": benchTimeouts,
+    "trajectory": benchTrajectory,
+    "values": benchValues,
+}
+
+def main(names):
+    for name in names or sorted(benchmarks):
+        print("== " + name)
+        benchmarks[name]()
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,280 @@
+""" Bus server letting many processes share lines owned by one process
+
+    Frames are a 5 byte header (payload length, code) followed by payload.
+    Request payload: name length, address, timeout in ms, priority, flags, line name, data.
+    Reply code is OK with result as payload or ERROR with exception name and message.
+    Exceptions with attributes listed in errorFields carry them as JSON list instead of message.
+"""
+import json
+import os
+from concurrent.futures import Future
+from datetime import timedelta
+from socket import socket, AF_UNIX, SOCK_STREAM
+from socketserver import ThreadingUnixStreamServer, BaseRequestHandler
+from struct import Struct
+from threading import Lock, Thread, local
+from .line import Timeout, DeadlineExpired, total_seconds
+from .adam import AdamModule, AdamError, BadReply, BadModuleType, Adam4068, Adam4024, Adam4017, Adam4053
+from .piv import Piv, PivCodec, PivError, BadPivPacket, BadPivModuleType, BadPivRelpy
+
+ADAM_QUERY = 1
+ADAM_WRITE = 2
+ADAM_RAW = 3
+PIV_QUERY = 4
+PIV_SEND = 5
+OK = 0
+ERROR = 1
+IDEMPOTENT = 1
+NO_PRIORITY = 255
+
+header = Struct("!IB")
+request = Struct("!BBIBB")
+
+def recvExact(sock, count):
+    data = bytearray()
+    while len(data) < count:
+        chunk = sock.recv(count - len(data))
+        if not chunk:
+            raise EOFError("Bus connection closed")
+        data += chunk
+    return bytes(data)
+
+def sendFrame(sock, code, payload):
+    sock.sendall(header.pack(len(payload), code) + payload)
+
+def recvFrame(sock):
+    length, code = header.unpack(recvExact(sock, header.size))
+    return code, recvExact(sock, length)
+
+def encodeRequest(code, name, address, timeout, data, priority=None, flags=0):
+    """Returns request payload, timeout is timedelta"""
+    name = name.encode("utf-8")
+    if priority is None:
+        priority = NO_PRIORITY
+    timeout = int(total_seconds(timeout) * 1000)
+    return request.pack(len(name), address, timeout, priority, flags) + name + bytes(data)
+
+def encodeError(e):
+    typeName = type(e).__name__
+    name = typeName.encode("utf-8")
+    fields = errorFields.get(typeName)
+    if fields is not None and errorTypes.get(typeName) is type(e):
+        message = json.dumps([getattr(e, field) for field in fields])
+    else:
+        message = str(e)
+    return bytes([len(name)]) + name + message.encode("utf-8", "replace")
+
+def decodeReply(code, payload):
+    """Returns result payload of OK reply, raises exception carried by ERROR reply"""
+    if code == OK:
+        return payload
+    errorName = payload[1:1 + payload[0]].decode("utf-8")
+    message = payload[1 + payload[0]:].decode("utf-8")
+    if errorName in errorFields:
+        raise errorTypes[errorName](*json.loads(message))
+    raise errorTypes.get(errorName, RuntimeError)(message)
+
+errorTypes = {
+    "Timeout": Timeout,
+    "DeadlineExpired": DeadlineExpired,
+    "BadPivPacket": BadPivPacket,
+    "BadPivModuleType": BadPivModuleType,
+    "BadPivRelpy": BadPivRelpy,
+    "PivError": PivError,
+    "AdamError": AdamError,
+    "BadReply": BadReply,
+    "BadModuleType": BadModuleType,
+}
+errorFields = {
+    "BadReply": ("request", "reply", "expected"),
+    "BadModuleType": ("expected", "actual"),
+}
+
+class BusExecutor(object):
+    """ Runs request payloads on local lines, lines is a dict {name: Line}
+        Identical read queries arriving while one is in progress share its bus transaction and result.
+    """
+    def __init__(self, lines):
+        self.lines = dict(lines)
+        self.coalesced = 0
+        self.__inflight__ = {}
+        self.__modules__ = {}
+        self.__lock__ = Lock()
+    def execute(self, code, payload):
+        nameLength, address, timeout, priority, flags = request.unpack_from(payload)
+        name = payload[request.size:request.size + nameLength].decode("utf-8")
+        data = payload[request.size + nameLength:]
+        timeout = timedelta(milliseconds=timeout)
+        if priority == NO_PRIORITY:
+            priority = None
+        if code in (ADAM_QUERY, ADAM_RAW) or (code == PIV_QUERY and flags & IDEMPOTENT):
+            return self.__coalesced__((code, name, address, data), lambda: self.__run__(code, name, address, timeout, priority, flags, data))
+        return self.__run__(code, name, address, timeout, priority, flags, data)
+    def __coalesced__(self, key, action):
+        with self.__lock__:
+            future = self.__inflight__.get(key)
+            owner = future is None
+            if owner:
+                future = self.__inflight__[key] = Future()
+            else:
+                self.coalesced += 1
+        if not owner:
+            return future.result()
+        try:
+            future.set_result(action())
+        except Exception as e:
+            future.set_exception(e)
+        finally:
+            with self.__lock__:
+                del self.__inflight__[key]
+        return future.result()
+    def __adam__(self, name, address, timeout):
+        """ Returns module cached per timeout too, as timeout is module state shared by its callers """
+        key = (name, address, timeout)
+        with self.__lock__:
+            module = self.__modules__.get(key)
+            if module is None:
+                module = self.__modules__[key] = AdamModule(self.lines[name], address)
+                module.timeout = timeout
+            return module
+    def __run__(self, code, name, address, timeout, priority, flags, data):
+        line = self.lines[name]
+        if code in (ADAM_QUERY, ADAM_WRITE, ADAM_RAW):
+            module = self.__adam__(name, address, timeout)
+            if code == ADAM_QUERY:
+                return module.query(data.decode("utf-8"), priority).encode("utf-8")
+            if code == ADAM_WRITE:
+                module.write(data.decode("utf-8"), priority, idempotent=bool(flags & IDEMPOTENT))
+                return b''
+            return module.rawQuery(data, lambda request, reply: reply, priority)
+        piv = Piv(line)
+        piv.timeout = timeout
+        if code == PIV_QUERY:
+            return bytes(piv.query(address, data, priority, idempotent=bool(flags & IDEMPOTENT)))
+        if code == PIV_SEND:
+            line.transact(lambda line: piv.send(address, data), priority, None, address)
+            return b''
+        raise ValueError("Unknown bus request code: %d" % code)
+
+class BusServer(object):
+    """ Serves AdamModule and Piv transactions on local lines over Unix domain socket
+        lines is a dict {name: Line}, requests are run by BusExecutor.
+    """
+    def __init__(self, path, lines):
+        self.path = path
+        self.executor = BusExecutor(lines)
+        self.lines = self.executor.lines
+        self.__thread__ = None
+        if os.path.exists(path):
+            os.unlink(path)
+        server = self
+        class Handler(BaseRequestHandler):
+            def handle(self):
+                server.__serve__(self.request)
+        self.__server__ = ThreadingUnixStreamServer(path, Handler)
+        self.__server__.daemon_threads = True
+    def serveForever(self):
+        self.__server__.serve_forever()
+    def start(self):
+        self.__thread__ = Thread(target=self.serveForever, name="BusServer", daemon=True)
+        self.__thread__.start()
+    def close(self):
+        self.__server__.shutdown()
+        self.__server__.server_close()
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+    def __serve__(self, sock):
+        while True:
+            try:
+                code, payload = recvFrame(sock)
+            except EOFError:
+                return
+            try:
+                result = self.executor.execute(code, payload)
+            except Exception as e:
+                sendFrame(sock, ERROR, encodeError(e))
+            else:
+                sendFrame(sock, OK, result)
+    @property
+    def coalesced(self):
+        return self.executor.coalesced
+
+class BusClient(object):
+    """Connection to BusServer, each thread uses its own socket"""
+    def __init__(self, path):
+        self.path = path
+        self.__local__ = local()
+    def __socket__(self):
+        sock = getattr(self.__local__, "socket", None)
+        if sock is None:
+            sock = socket(AF_UNIX, SOCK_STREAM)
+            sock.connect(self.path)
+            self.__local__.socket = sock
+        return sock
+    def call(self, code, name, address, timeout, data, priority=None, flags=0):
+        sock = self.__socket__()
+        try:
+            sendFrame(sock, code, encodeRequest(code, name, address, timeout, data, priority, flags))
+            code, payload = recvFrame(sock)
+        except (OSError, EOFError):
+            self.__local__.socket = None
+            sock.close()
+            raise
+        return decodeReply(code, payload)
+    def line(self, name):
+        return RemoteLine(self, name)
+    def close(self):
+        sock = getattr(self.__local__, "socket", None)
+        if sock is not None:
+            sock.close()
+            self.__local__.socket = None
+
+class RemoteLine(object):
+    """Line owned by BusServer, pass it to Remote* module classes"""
+    def __init__(self, client, name):
+        self.client = client
+        self.name = name
+
+class RemoteAdamModule(AdamModule):
+    """AdamModule transacting through BusServer, replyLength hints are left to server side modules"""
+    def query(self, command, priority=None, queueTimeout=None, replyLength=None):
+        line = self.__line__
+        return line.client.call(ADAM_QUERY, line.name, self.__addressNum__, self.timeout, bytes(command, "utf-8"), priority).decode("utf-8")
+    def write(self, data, priority=None, queueTimeout=None, idempotent=True):
+        line = self.__line__
+        line.client.call(ADAM_WRITE, line.name, self.__addressNum__, self.timeout, bytes(data, "utf-8"), priority, IDEMPOTENT if idempotent else 0)
+    def writeFormat(self, template, values, priority=None, queueTimeout=None, idempotent=True):
+        self.write((template % values).decode("utf-8"), priority, queueTimeout, idempotent)
+    def rawQuery(self, request, parse, priority=None, queueTimeout=None, replyLength=None):
+        line = self.__line__
+        request = bytes(request)
+        return parse(request, line.client.call(ADAM_RAW, line.name, self.__addressNum__, self.timeout, request, priority))
+
+class RemoteAdam4068(RemoteAdamModule, Adam4068):
+    pass
+
+class RemoteAdam4024(RemoteAdamModule, Adam4024):
+    pass
+
+class RemoteAdam4017(RemoteAdamModule, Adam4017):
+    pass
+
+class RemoteAdam4053(RemoteAdamModule, Adam4053):
+    pass
+
+class RemotePiv(Piv):
+    """Piv transacting through BusServer, usable with Kshd and other PivModule classes"""
+    def __init__(self, line):
+        assert(isinstance(line, RemoteLine))
+        self.__line__ = line
+        self.timeout = timedelta(seconds=1)
+        self.retryPolicy = None
+        self.__rtt__ = {}
+    def query(self, address, request, priority=None, queueTimeout=None, idempotent=True, replyLength=None):
+        line = self.__line__
+        return line.client.call(PIV_QUERY, line.name, address, self.timeout, request, priority, IDEMPOTENT if idempotent else 0)
+    def queryFrame(self, address, frame, priority=None, queueTimeout=None, idempotent=True, replyLength=None):
+        return self.query(address, PivCodec.decodeFrame(frame[:-1])[1:], priority, queueTimeout, idempotent, replyLength)
+    def send(self, address, data):
+        line = self.__line__
+        line.client.call(PIV_SEND, line.name, address, self.timeout, data)
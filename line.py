@@ -1,6 +1,11 @@
-from datetime import datetime, timedelta
+from collections import deque
+from datetime import timedelta
 from errno import EAGAIN
+from socket import error as socket_error, timeout as socket_timeout, create_connection
+from socket import IPPROTO_TCP, SOL_SOCKET, SO_KEEPALIVE, TCP_NODELAY, MSG_PEEK
+from select import select
 from threading import Lock
+from time import monotonic, monotonic_ns, sleep
 
 def total_seconds(delta):
     assert(isinstance(delta, timedelta))
@@ -9,9 +14,37 @@ def total_seconds(delta):
     except AttributeError:
         return delta.microseconds / 1000000. + delta.seconds + delta.days * 3600*24
 
+def nanoseconds(delta):
+    """Converts timedelta to integer nanoseconds without rounding"""
+    return ((delta.days * 86400 + delta.seconds) * 1000000 + delta.microseconds) * 1000
+
+def deadlineAfter(timeout):
+    """Returns monotonic_ns() value timeout (timedelta) from now"""
+    return monotonic_ns() + nanoseconds(timeout)
+
 class Timeout(RuntimeError):
     pass
 
+class DeadlineExpired(Timeout):
+    """Transaction was dropped unsent because it waited for the line longer than its queueTimeout"""
+    pass
+
+def tryUntilDeadline(action, deadline):
+    """ Tries perform action until deadline (monotonic_ns() value) is reached
+        Action should:
+        - accept a single argument - nanoseconds until deadline
+        - return false value if tries should be continued
+        Returns last action result
+    """
+    left = max(0, deadline - monotonic_ns())
+    while True:
+        rv = action(left)
+        if rv:
+            return rv
+        left = deadline - monotonic_ns()
+        if left < 0:
+            return rv
+
 def tryUntilTimeout(action, timeout):
     """ Tries perform action until timeout is reached
         timeout argument should be of type timedelta
@@ -21,143 +54,638 @@ def tryUntilTimeout(action, timeout):
         Returns last action result
     """
     assert(isinstance(timeout, timedelta))
-    until = datetime.now() + timeout
-    while True:  
-        rv = action(timeout)
-        if rv:
-            return rv
-        timeout = until - datetime.now()
-        if timeout < timedelta(0):
-            return rv
+    return tryUntilDeadline(lambda left: action(timedelta(microseconds=left // 1000)), deadlineAfter(timeout))
 
 def tohex(data):
-    rv=""
-    for b in data:
-        rv+="%02X" % b
-    return rv
+    return bytes(data).hex().upper()
 
 class PersistentSocket(object):
-    """Imitates auto-reconnecting socket"""
-    def __init__(self, address):
+    """ Imitates auto-reconnecting socket
+        Broken connection is reestablished on next use. Failed attempts are spaced by
+        exponential backoff with jitter. sendall() resends data over a fresh connection
+        instead of dropping it. recvReady() lets a reactor thread read the current connection
+        while another thread writes, connection is replaced only by the thread which found it broken.
+    """
+    def __init__(self, address, keepalive=True, nodelay=True, connectTimeout=5., minBackoff=0.1, maxBackoff=30., retries=3):
         self.address = address
-        self.__socket__ = create_connection(self.address)         
+        self.keepalive = keepalive
+        self.nodelay = nodelay
+        self.connectTimeout = connectTimeout
+        self.minBackoff = minBackoff
+        self.maxBackoff = maxBackoff
+        self.retries = retries
+        self.reconnects = 0
+        self.lastConnectTime = 0.
+        self.downtime = 0.
+        self.listeners = []
+        self.__timeout__ = None
+        self.__backoff__ = 0.
+        self.__nextAttempt__ = 0.
+        self.__downSince__ = None
+        self.__socket__ = None
+        self.__lock__ = Lock()
+        self.__connect__()
     @staticmethod
     def create_connection(address):
         return PersistentSocket(address)
+    def __connect__(self, timeout=None):
+        started = monotonic()
+        if timeout is None or timeout > self.connectTimeout:
+            timeout = self.connectTimeout
+        try:
+            sock = create_connection(self.address, timeout)
+        except OSError:
+            from random import uniform
+            self.__backoff__ = min(self.maxBackoff, max(self.minBackoff, 2 * self.__backoff__))
+            self.__nextAttempt__ = monotonic() + uniform(0, self.__backoff__)
+            raise
+        if self.keepalive:
+            sock.setsockopt(SOL_SOCKET, SO_KEEPALIVE, 1)
+        if self.nodelay:
+            sock.setsockopt(IPPROTO_TCP, TCP_NODELAY, 1)
+        sock.settimeout(self.__timeout__)
+        with self.__lock__:
+            self.__socket__ = sock
+        now = monotonic()
+        self.lastConnectTime = now - started
+        self.__backoff__ = 0.
+        if self.__downSince__ is not None:
+            self.reconnects += 1
+            self.downtime += now - self.__downSince__
+            self.__downSince__ = None
+        self.__notify__()
+        return sock
+    def __disconnect__(self, sock=None):
+        """Closes current connection, or only sock if it is still current"""
+        with self.__lock__:
+            current = self.__socket__
+            if current is None or (sock is not None and sock is not current):
+                return
+            self.__socket__ = None
+            self.__downSince__ = monotonic()
+        try:
+            current.close()
+        finally:
+            self.__notify__()
+    def __notify__(self):
+        """Calls listener(socket) after connection is established or lost"""
+        for listener in self.listeners:
+            listener(self)
+    def __connected__(self, maxWait=None):
+        """Returns connected socket, waits at most maxWait seconds for backoff to expire"""
+        sock = self.__socket__
+        if sock is None:
+            wait = self.__nextAttempt__ - monotonic()
+            if maxWait is not None and (maxWait <= 0 or maxWait < wait):
+                sleep(max(0, maxWait))
+                raise socket_timeout("Reconnect to %s is delayed" % (self.address,))
+            if wait > 0:
+                sleep(wait)
+                if maxWait is not None:
+                    maxWait -= wait
+            sock = self.__connect__(maxWait)
+        return sock
     def settimeout(self, timeout):
-        return self.__socket__.settimeout(timeout)
+        self.__timeout__ = timeout
+        if self.__socket__ is not None:
+            self.__socket__.settimeout(timeout)
     def gettimeout(self):
-        return self.__socket__.gettimeout()
+        return self.__timeout__
+    def fileno(self):
+        return self.__connected__().fileno()
+    def connectedFileno(self):
+        """Returns descriptor of current connection or None, never connects"""
+        sock = self.__socket__
+        if sock is None:
+            return None
+        return sock.fileno()
     def recv(self, byteCount):
-        return self.__socket__.recv(byteCount)
-    def sendall(self, data):
-        
-        return self.__socket__.sendall(data)
+        buffer = bytearray(byteCount)
+        return bytes(buffer[0:self.recv_into(buffer, byteCount)])
+    def recv_into(self, buffer, byteCount=0):
+        """Returns 0 and schedules reconnect when connection is lost"""
+        sock = None
+        try:
+            sock = self.__connected__(self.__timeout__)
+            count = sock.recv_into(buffer, byteCount)
+        except socket_timeout:
+            raise
+        except OSError as e:
+            if e.errno == EAGAIN:
+                raise
+            count = 0
+        if not count:
+            self.__disconnect__(sock)
+        return count
+    def recvReady(self, buffer):
+        """ Reads data already received by current connection, never waits or connects
+            Returns 0 and schedules reconnect when connection is lost, raises BlockingIOError if there is no data.
+        """
+        sock = self.__socket__
+        if sock is None:
+            return 0
+        try:
+            if not select([sock], [], [], 0)[0]:
+                raise BlockingIOError(EAGAIN, "No data received")
+            count = sock.recv_into(buffer)
+        except (BlockingIOError, socket_timeout):
+            raise
+        except (OSError, ValueError):
+            count = 0
+        if not count:
+            self.__disconnect__(sock)
+        return count
+    def __peerClosed__(self):
+        """Detects connection closed by gateway while idle, so that next request is not lost"""
+        sock = self.__socket__
+        if sock is None:
+            return False
+        try:
+            if not select([sock], [], [], 0)[0]:
+                return False
+            return sock.recv(1, MSG_PEEK) == b''
+        except (OSError, ValueError):
+            return True
+    def sendall(self, data, maxWait=None):
+        """ maxWait limits seconds spent on reconnecting, socket.timeout is raised when it runs out """
+        deadline = None if maxWait is None else monotonic() + maxWait
+        sock = self.__socket__
+        if self.__peerClosed__():
+            self.__disconnect__(sock)
+        for attempt in range(self.retries + 1):
+            sock = None
+            try:
+                sock = self.__connected__(None if deadline is None else deadline - monotonic())
+                return sock.sendall(data)
+            except socket_timeout:
+                raise
+            except OSError:
+                self.__disconnect__(sock)
+                if attempt == self.retries:
+                    raise
+    def close(self):
+        self.__disconnect__()
+        self.__downSince__ = None
+    def metrics(self):
+        downtime = self.downtime
+        if self.__downSince__ is not None:
+            downtime += monotonic() - self.__downSince__
+        return {
+            "address": self.address,
+            "connected": self.__socket__ is not None,
+            "reconnects": self.reconnects,
+            "lastConnectTime": self.lastConnectTime,
+            "downtime": downtime,
+        }
+
+class ConnectionPool(object):
+    """ Keeps one warm SocketLine per gateway address
+        All modules on a gateway share its line and therefore its persistent connection.
+        Keyword arguments are passed to PersistentSocket.
+    """
+    def __init__(self, **options):
+        self.options = options
+        self.__lines__ = {}
+        self.__lock__ = Lock()
+    def line(self, address):
+        with self.__lock__:
+            line = self.__lines__.get(address)
+            if line is None:
+                line = SocketLine(PersistentSocket(address, **self.options))
+                self.__lines__[address] = line
+            return line
+    def metrics(self):
+        with self.__lock__:
+            return [line.__socket__.metrics() for line in self.__lines__.values()]
+    def close(self):
+        with self.__lock__:
+            for line in self.__lines__.values():
+                line.__socket__.close()
+            self.__lines__.clear()
+
+class BufferOverflow(RuntimeError):
+    pass
+
+class LineBuffer(object):
+    """ Receive buffer with offset tracking
+        Unread data occupies [start, end) of preallocated storage, taking a line only advances start.
+        Storage is compacted when free tail space runs out and grows up to highWater bytes.
+        Delimiter search resumes where previous unsuccessful search stopped.
+    """
+    def __init__(self, capacity=4096, highWater=65536):
+        assert(capacity > 0)
+        self.__data__ = bytearray(capacity)
+        self.__view__ = memoryview(self.__data__)
+        self.__start__ = 0
+        self.__end__ = 0
+        self.__scanned__ = 0
+        self.__scannedFor__ = None
+        self.highWater = highWater
+    def __len__(self):
+        return self.__end__ - self.__start__
+    def __bytes__(self):
+        return bytes(self.__view__[self.__start__:self.__end__])
+    def clear(self):
+        self.__start__ = self.__end__ = self.__scanned__ = 0
+    def reserve(self, size=1):
+        """ Returns writable memoryview of free space at least size bytes long.
+            Call commit() with number of bytes actually stored.
+        """
+        if len(self.__data__) - self.__end__ >= size:
+            return self.__view__[self.__end__:]
+        length = len(self)
+        if length + size <= len(self.__data__):
+            self.__view__[0:length] = self.__view__[self.__start__:self.__end__]
+        else:
+            capacity = max(2 * len(self.__data__), length + size)
+            if capacity > self.highWater:
+                capacity = self.highWater
+            if length + size > capacity:
+                self.clear()
+                raise BufferOverflow("Line buffer exceeded %d bytes without delimiter" % self.highWater)
+            data = bytearray(capacity)
+            view = memoryview(data)
+            view[0:length] = self.__view__[self.__start__:self.__end__]
+            self.__data__ = data
+            self.__view__ = view
+        self.__scanned__ -= self.__start__
+        self.__start__ = 0
+        self.__end__ = length
+        return self.__view__[self.__end__:]
+    def commit(self, count):
+        assert(self.__end__ + count <= len(self.__data__))
+        self.__end__ += count
+    def append(self, data):
+        count = len(data)
+        self.reserve(count)[0:count] = data
+        self.commit(count)
+    def readline(self, delimiter):
+        """Returns bytes preceding delimiter and consumes them, returns None if there is no delimiter yet"""
+        start = self.__start__
+        if delimiter == self.__scannedFor__:
+            start = max(start, self.__scanned__)
+        self.__scannedFor__ = delimiter
+        eolPosition = self.__data__.find(delimiter, start, self.__end__)
+        if eolPosition < 0:
+            self.__scanned__ = max(self.__start__, self.__end__ - len(delimiter) + 1)
+            return None
+        line = bytes(self.__view__[self.__start__:eolPosition])
+        self.__start__ = self.__scanned__ = eolPosition + len(delimiter)
+        if self.__start__ == self.__end__:
+            self.clear()
+        return line
 
 class Line(object):
     """Abstract RS485 line"""
-    def __init__(self):
-        self.__buffer__ = bytearray()
+    def __init__(self, highWater=65536, name=None):
+        """name identifies the bus across restarts, see registry.ModuleRegistry"""
+        self.__buffer__ = LineBuffer(min(4096, highWater), highWater)
+        self.name = name
         self.lock = Lock()
+        self.scheduler = None
+        self.tracer = None
+        self.reactor = None
+        self.bytesWritten = 0
+        self.bytesRead = 0
+        self.pipelineDepth = None
     def write(self, data):
         raise NotImplemented
+    def writeUntil(self, data, deadline):
+        """ Same as write() for transactions, deadline is monotonic_ns() value
+            Lines which may wait before sending, such as reconnecting SocketLine,
+            should override it and raise Timeout when deadline passes.
+        """
+        self.write(data)
+
+    def transact(self, action, priority=None, queueTimeout=None, address=None):
+        """ Runs action(line) with exclusive access to the line and returns its result
+            When scheduler.LineScheduler is attached, transaction is queued by priority,
+            otherwise line.lock is used and priority is ignored. Either way transaction not started
+            within queueTimeout (timedelta) is dropped with DeadlineExpired.
+            Transactions issued from within a scheduled transaction run immediately.
+            address identifies the module for trace.Tracer when one is attached.
+        """
+        if self.tracer is not None:
+            action = self.tracer.wrap(address, action)
+        scheduler = self.scheduler
+        if scheduler is not None:
+            if scheduler.isWorker():
+                return action(self)
+            return scheduler.submit(action, priority, queueTimeout).result()
+        if queueTimeout is None:
+            with self.lock:
+                return action(self)
+        assert(isinstance(queueTimeout, timedelta))
+        if not self.lock.acquire(timeout=total_seconds(queueTimeout)):
+            raise DeadlineExpired("Transaction dropped after waiting %.3f s for line" % total_seconds(queueTimeout))
+        try:
+            return action(self)
+        finally:
+            self.lock.release()
+
+    def pollMany(self, batch, timeout=None, priority=None, queueTimeout=None, arrivals=None):
+        """ Queries many modules sharing this line with pipelined requests
+            batch is a sequence of (module, command) pairs. Modules should provide
+            pollRequest(), pollMatch(), pollReply() and share the same pollDelimiter.
+            Requests are written back to back, at most pipelineDepth (unlimited if None) at once,
+            replies are matched to requests by module address.
+            timeout defaults to the largest module timeout and applies to every chunk.
+            Returns list of results in batch order, failed queries are represented by exception instances.
+            When arrivals list is given, it receives monotonic() time of each reply arrival or None.
+        """
+        batch = list(batch)
+        if not batch:
+            return []
+        delimiter = batch[0][0].pollDelimiter
+        requests = []
+        for module, command in batch:
+            assert(module.pollDelimiter == delimiter)
+            requests.append(module.pollRequest(command))
+        if timeout is None:
+            timeout = max(module.timeout for module, command in batch)
+        assert(isinstance(timeout, timedelta))
+        timeout = nanoseconds(timeout)
+        results = [None] * len(batch)
+        if arrivals is not None:
+            arrivals[:] = [None] * len(batch)
+        depth = self.pipelineDepth or len(batch)
+        def transaction(line):
+            for start in range(0, len(batch), depth):
+                line.__pollChunk__(batch, requests, range(start, min(start + depth, len(batch))), results, delimiter, timeout, arrivals)
+            return results
+        return self.transact(transaction, priority, queueTimeout)
+    def __pollChunk__(self, batch, requests, indices, results, delimiter, timeout, arrivals):
+        pending = {}
+        for i in indices:
+            pending.setdefault(requests[i][1], deque()).append(i)
+        deadline = monotonic_ns() + timeout
+        remaining = len(indices)
+        try:
+            self.writeUntil(b"".join(requests[i][0] for i in indices), deadline)
+        except Timeout:
+            remaining = 0
+        matcher = batch[indices[0]][0]
+        while remaining:
+            try:
+                reply = self.readlineUntil(deadline, delimiter)
+            except Timeout:
+                break
+            try:
+                key, payload = matcher.pollMatch(reply)
+            except RuntimeError:
+                continue # Corrupted reply, its owner will time out
+            waiting = pending.get(key)
+            if not waiting:
+                continue
+            i = waiting.popleft()
+            remaining -= 1
+            if arrivals is not None:
+                arrivals[i] = monotonic()
+            module, command = batch[i]
+            try:
+                results[i] = module.pollReply(command, payload)
+            except RuntimeError as e:
+                results[i] = e
+        for waiting in pending.values():
+            for i in waiting:
+                results[i] = Timeout("No reply to pipelined request: " + str(requests[i][0]))
+        if self.tracer is not None:
+            for i in indices:
+                if isinstance(results[i], Exception):
+                    self.tracer.countError(self, requests[i][1], results[i])
+
+    def discard(self, limit=16):
+        """Drops buffered input and input already waiting in device, such as late replies"""
+        if self.reactor is not None:
+            return self.reactor.discard(self)
+        for i in range(limit):
+            self.__buffer__.clear()
+            self.readUntil(monotonic_ns())
+            if not len(self.__buffer__):
+                return
+        self.__buffer__.clear()
 
     def readWithTimeout(self, timeout):
         """Reads into buffer until at least one byte is read or timeout is expired."""
         assert(isinstance(timeout, timedelta))
         raise NotImplemented
-    def readline(self, timeout, delimiter=b'\r'):
+    def readUntil(self, deadline):
+        """ Same as readWithTimeout() with deadline given as monotonic_ns() value
+            Lines should override it, default implementation calls readWithTimeout().
+        """
+        self.readWithTimeout(timedelta(microseconds=max(0, deadline - monotonic_ns()) // 1000))
+    def fileno(self):
+        """Returns descriptor to wait on with reactor.LineReactor, None while it is unavailable"""
+        raise NotImplementedError
+    def readReady(self):
+        """ Reads input available without blocking into buffer, used by reactor.LineReactor
+            Returns number of bytes read, 0 on end of stream.
+        """
+        raise NotImplementedError
+    def onDescriptorChange(self, callback):
+        """Registers callback() called when fileno() changes, such as on reconnect"""
+        pass
+    def readline(self, timeout, delimiter=b'\r', expected=None):
+        """ Returns next non-empty line without delimiter
+            expected is a hint of line length including delimiter for lines able to read in bulk.
+        """
         assert(isinstance(timeout, timedelta))
-        def tryReadLine(timeout):
-            def processBuf():
-                eolPosition = self.__buffer__.find(delimiter)
-                if eolPosition >= 0:
-                    line = self.__buffer__[0:eolPosition]
-                    self.__buffer__ = self.__buffer__[eolPosition + len(delimiter):]
-                    return line
-                return None
-            line = processBuf()
+        return self.readlineUntil(deadlineAfter(timeout), delimiter, expected)
+    def readlineUntil(self, deadline, delimiter=b'\r', expected=None):
+        """ Same as readline() with deadline given as monotonic_ns() value """
+        if self.reactor is not None:
+            line = self.reactor.readline(self, deadline, delimiter)
+            self.bytesRead += len(line) + len(delimiter)
+            return line
+        buffer = self.__buffer__
+        expired = False
+        while True:
+            line = buffer.readline(delimiter)
             if line:
+                self.bytesRead += len(line) + len(delimiter)
                 return line
-            self.readWithTimeout(timeout)
-            return processBuf()
-        line = tryUntilTimeout(tryReadLine, timeout)
-        if not line:
-            raise Timeout("Line read timeout. Data read so far: " + str(self.__buffer__))
-        return line
+            if line is None:
+                if expired:
+                    raise Timeout("Line read timeout. Data read so far: " + str(bytes(buffer)))
+                self.readUntil(deadline)
+                expired = monotonic_ns() >= deadline
 
 class SerialLine(Line):
-    """Makes use of RS232 to RS485 converters"""
-    from serial import Serial, SerialTimeoutException
-    def __init__(self, serial):
-        assert(isinstance(serial, SerialLine.Serial))
-        Line.__init__(self)
+    """ Makes use of RS232 to RS485 converters
+        With bulkRead enabled, replies are read with a single read() of expected length
+        (see readline()) or, when it is unknown or wrong, with reads lasting gapCharacters
+        character times, instead of byte by byte.
+        turnaround (timedelta) is a pause after request is transmitted, before reply is awaited,
+        for converters and modules needing time to switch direction.
+        pyserial is imported on construction, socket-only deployments don't need it.
+    """
+    def __init__(self, serial, highWater=65536, bulkRead=False, turnaround=None, gapCharacters=3.5):
+        from serial import Serial, SerialTimeoutException
+        assert(isinstance(serial, Serial))
+        self.__timeoutError__ = SerialTimeoutException
+        Line.__init__(self, highWater, serial.port)
         self.__serial__ = serial
+        self.bulkRead = bulkRead
+        self.turnaround = turnaround
+        self.gapCharacters = gapCharacters
+        self.bulkChunk = 256
+    def characterTime(self):
+        """Returns transfer time of one character in seconds: start, data, parity and stop bits"""
+        serial = self.__serial__
+        bits = 1 + serial.bytesize + serial.stopbits
+        if serial.parity != "N":
+            bits += 1
+        return bits / float(serial.baudrate)
     def write(self, data):
+        self.bytesWritten += len(data)
         self.__serial__.write(data)
+        if self.turnaround is not None:
+            self.__serial__.flush()
+            sleep(total_seconds(self.turnaround))
     def readWithTimeout(self, timeout):
         assert(isinstance(timeout, timedelta))
-        if (self.__serial__.inWaiting() > 0):
-            self.__buffer__ += self.__serial__.read(self.__serial__.inWaiting())
+        self.readUntil(deadlineAfter(timeout))
+    def readUntil(self, deadline):
+        serial = self.__serial__
+        waiting = serial.inWaiting()
+        if waiting > 0:
+            self.__buffer__.append(serial.read(waiting))
             return
-        self.__serial__.timeout = total_seconds(timeout)
+        serial.timeout = max(0, deadline - monotonic_ns()) / 1e9
         try:
-            self.__buffer__ += self.__serial__.read(1)
-        except SerialLine.SerialTimeoutException:
+            self.__buffer__.append(serial.read(1))
+        except self.__timeoutError__:
             pass
+    def fileno(self):
+        return self.__serial__.fileno()
+    def readReady(self):
+        serial = self.__serial__
+        data = serial.read(serial.inWaiting())
+        self.__buffer__.append(data)
+        return len(data)
+    def __waitInput__(self, deadline):
+        """ Waits for input until deadline without reconfiguring port, returns False if none arrived """
+        serial = self.__serial__
+        try:
+            fd = serial.fileno()
+        except (AttributeError, OSError): # No descriptor to select on, such as on Windows
+            fd = None
+        while True:
+            left = deadline - monotonic_ns()
+            if left <= 0:
+                return False
+            if fd is not None:
+                return bool(select([fd], [], [], left / 1e9)[0])
+            if serial.inWaiting() > 0:
+                return True
+            sleep(min(left / 1e9, serial.timeout))
+    def readlineUntil(self, deadline, delimiter=b'\r', expected=None):
+        """ expected is reply length including delimiter if known, used by bulkRead mode
+            pyserial read() waits for all requested bytes until timeout passes and reconfigures
+            the port on every timeout change. So timeout is set to the gap once and kept, reply start
+            is awaited with select(), then expected bytes or, when they are read or unknown,
+            bulkChunk bytes are requested. A read therefore ends at most a gap after the reply.
+        """
+        if not self.bulkRead or self.reactor is not None:
+            return Line.readlineUntil(self, deadline, delimiter)
+        serial = self.__serial__
+        buffer = self.__buffer__
+        gap = self.characterTime() * self.gapCharacters
+        if serial.timeout != gap:
+            serial.timeout = gap
+        while True:
+            line = buffer.readline(delimiter)
+            if line:
+                self.bytesRead += len(line) + len(delimiter)
+                return line
+            if line is not None:
+                continue
+            if monotonic_ns() > deadline:
+                raise Timeout("Line read timeout. Data read so far: " + str(bytes(buffer)))
+            waiting = serial.inWaiting()
+            if not waiting and not self.__waitInput__(deadline):
+                raise Timeout("Line read timeout. Data read so far: " + str(bytes(buffer)))
+            count = (expected or 0) - len(buffer)
+            if count <= 0:
+                count = self.bulkChunk
+            buffer.append(serial.read(max(count, waiting)))
 
 
 class SocketLine(Line):
     """Makes use of TCP/IP to RS485 converters"""
-    from socket import error as socket_error, timeout as socket_timeout, create_connection
-    def __init__(self, socket):
-        Line.__init__(self)
+    def __init__(self, socket, highWater=65536):
+        Line.__init__(self, highWater, getattr(socket, "address", None))
         self.__socket__ = socket
     def readWithTimeout(self, timeout):
         """Reads socket into buffer until at least one byte is read or timeout is expired."""
         assert(isinstance(timeout, timedelta))
+        self.readUntil(deadlineAfter(timeout))
+    def readUntil(self, deadline):
         socket = self.__socket__
         try:
-            socket.settimeout(total_seconds(timeout))
-            data = socket.recv(4092)
-            if len(data):
-                self.__buffer__ += data
-                return
-            #print("Waiting")
-            self.__buffer__ += socket.recv(1)
+            socket.settimeout(max(0, deadline - monotonic_ns()) / 1e9)
+            self.__buffer__.commit(socket.recv_into(self.__buffer__.reserve()))
         except socket_timeout as e:
             return
         except socket_error as e:
             if e.errno == EAGAIN:
                 return
             raise       
-                        
+    def fileno(self):
+        socket = self.__socket__
+        if isinstance(socket, PersistentSocket):
+            return socket.connectedFileno()
+        return socket.fileno()
+    def readReady(self):
+        socket = self.__socket__
+        if isinstance(socket, PersistentSocket):
+            count = socket.recvReady(self.__buffer__.reserve())
+        else:
+            count = socket.recv_into(self.__buffer__.reserve())
+        self.__buffer__.commit(count)
+        return count
+    def onDescriptorChange(self, callback):
+        if isinstance(self.__socket__, PersistentSocket):
+            self.__socket__.listeners.append(lambda socket: callback())
     def write(self, data):
+        self.bytesWritten += len(data)
+        self.__socket__.sendall(data)
+    def writeUntil(self, data, deadline):
+        """Raises Timeout if PersistentSocket can't reconnect before deadline"""
         socket = self.__socket__
-        oldtimeout = socket.gettimeout()
+        if not isinstance(socket, PersistentSocket):
+            return self.write(data)
+        self.bytesWritten += len(data)
         try:
-            self.__socket__.sendall(data)
-        finally:
-            socket.settimeout(oldtimeout)
+            socket.sendall(data, (deadline - monotonic_ns()) / 1e9)
+        except socket_timeout:
+            raise Timeout("Can't connect to %s before deadline" % (socket.address,)) from None
 
 
-class DebugLine(object):
+class DebugLine(Line):
+    """ Prints traffic of wrapped line, see trace.Tracer for production use """
     def __init__(self, line, prefix=""):
+        Line.__init__(self, name=getattr(line, "name", None))
         self.__line__ = line
         self.prefix = prefix
-        self.lock = Lock()
     def write(self, data):
         print(self.prefix,"sending ",tohex(data))
+        self.bytesWritten += len(data)
         self.__line__.write(data)
-    def readline(self, timeout, delimiter=b'\r'):
-        rv = self.__line__.readline(timeout, delimiter)
+    def writeUntil(self, data, deadline):
+        print(self.prefix,"sending ",tohex(data))
+        self.bytesWritten += len(data)
+        self.__line__.writeUntil(data, deadline)
+    def discard(self, limit=16):
+        print(self.prefix,"discarding",tohex(bytes(self.__line__.__buffer__)))
+        self.__line__.discard(limit)
+    def readlineUntil(self, deadline, delimiter=b'\r', expected=None):
+        rv = self.__line__.readlineUntil(deadline, delimiter, expected)
         print(self.prefix,"read line",tohex(rv))
+        self.bytesRead += len(rv) + len(delimiter)
         return rv
     def readWithTimeout(self, timeout):
-        rv = self.__line__.readWithTimeout(timeout)
-        print(self.prefix,"read ",tohex(rv))
-        return rv
-    
-
-        
-        
+        self.readUntil(deadlineAfter(timeout))
+    def readUntil(self, deadline):
+        self.__line__.readUntil(deadline)
+        print(self.prefix,"buffered ",tohex(bytes(self.__line__.__buffer__)))
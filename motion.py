@@ -0,0 +1,310 @@
+from concurrent.futures import Future
+from datetime import timedelta
+from math import sqrt
+from threading import Condition, Lock, Thread
+from time import monotonic, sleep
+from .line import total_seconds
+from .piv import Kshd, BadPivRelpy
+from .scheduler import LineScheduler
+
+def remainingTime(steps, speed):
+    """ Predicts seconds to finish a move of steps with Kshd.SpeedConf profile
+        Assumes axis cruises at speed.max and decelerates with speed.acc down to speed.min.
+    """
+    steps = abs(steps)
+    vmin, vmax, acc = float(speed.min), float(speed.max), float(speed.acc)
+    brake = (vmax * vmax - vmin * vmin) / (2 * acc)
+    if steps > brake:
+        return (steps - brake) / vmax + (vmax - vmin) / acc
+    return (sqrt(vmin * vmin + 2 * acc * steps) - vmin) / acc
+
+class Watch(object):
+    """Move of a single axis followed by MotionMonitor"""
+    def __init__(self, kshd, speed):
+        self.kshd = kshd
+        self.speed = speed
+        self.future = Future()
+        self.due = 0.
+        self.failures = 0
+        self.atLimit = False
+        self.lastSteps = None
+        self.lastPoll = None
+
+class MotionLoop(object):
+    """Polling thread of MotionMonitor shared by watched axes of one line"""
+    def __init__(self, monitor, name):
+        self.monitor = monitor
+        self.__watches__ = []
+        self.__condition__ = Condition()
+        self.__closed__ = False
+        self.__thread__ = Thread(target=self.__run__, name="MotionMonitor %s" % name, daemon=True)
+        self.__thread__.start()
+    def add(self, watch):
+        with self.__condition__:
+            self.__watches__.append(watch)
+            self.__condition__.notify()
+    def close(self):
+        with self.__condition__:
+            self.__closed__ = True
+            self.__condition__.notify()
+        self.__thread__.join()
+        for watch in self.__watches__:
+            watch.future.cancel()
+    def __run__(self):
+        monitor = self.monitor
+        while True:
+            with self.__condition__:
+                while True:
+                    if self.__closed__:
+                        return
+                    self.__watches__ = [w for w in self.__watches__ if not w.future.cancelled()]
+                    if self.__watches__:
+                        watch = min(self.__watches__, key=lambda w: w.due)
+                        wait = watch.due - monotonic()
+                        if wait <= 0:
+                            break
+                        self.__condition__.wait(wait)
+                    else:
+                        self.__condition__.wait()
+            try:
+                done = monitor.__poll__(watch)
+                watch.failures = 0
+            except Exception as e:
+                watch.failures += 1
+                watch.due = monotonic() + monitor.minInterval
+                done = watch.failures >= monitor.attempts
+                if done:
+                    watch.future.set_exception(e)
+            if done:
+                with self.__condition__:
+                    if watch in self.__watches__:
+                        self.__watches__.remove(watch)
+
+class MotionMonitor(object):
+    """ Follows moves of many Kshd axes with one polling thread per line
+        Axes of a line share its thread, as their transactions are serialized by the bus anyway,
+        so an unresponsive axis delays only axes on its own line.
+        Each axis is polled with interval derived from predicted time to completion:
+        rarely while target is far and densely near the end of the move.
+        Prediction uses SpeedConf of axis or, when it is unknown, measured step rate.
+    """
+    def __init__(self, minInterval=timedelta(milliseconds=5), maxInterval=timedelta(milliseconds=500), readCoordinate=True, attempts=3):
+        self.minInterval = total_seconds(minInterval)
+        self.maxInterval = total_seconds(maxInterval)
+        self.readCoordinate = readCoordinate
+        self.attempts = attempts
+        self.limitCallbacks = []
+        self.__loops__ = {}
+        self.__lock__ = Lock()
+        self.__closed__ = False
+    def watch(self, kshd, speed=None):
+        """ Returns concurrent.futures.Future resolved with Kshd.Status once axis is ready
+            speed is Kshd.SpeedConf used for prediction, cached speed of kshd is used if omitted.
+            Use asyncio.wrap_future() to await it from event loop.
+        """
+        if speed is None:
+            speed = kshd.cachedSpeed()
+        watch = Watch(kshd, speed)
+        watch.due = monotonic()
+        line = kshd.__piv__.__line__
+        with self.__lock__:
+            if self.__closed__:
+                raise RuntimeError("Motion monitor is closed")
+            loop = self.__loops__.get(line)
+            if loop is None:
+                loop = self.__loops__[line] = MotionLoop(self, getattr(line, "name", None))
+            loop.add(watch)
+        return watch.future
+    def onLimit(self, callback):
+        """Registers callback(kshd, status) called when axis reaches plus or minus limit switch"""
+        self.limitCallbacks.append(callback)
+    def close(self):
+        with self.__lock__:
+            self.__closed__ = True
+            loops = list(self.__loops__.values())
+        for loop in loops:
+            loop.close()
+    def __interval__(self, watch, steps, now):
+        if watch.speed is not None:
+            remaining = remainingTime(steps, watch.speed)
+        elif watch.lastSteps is not None and watch.lastSteps > steps:
+            remaining = steps * (now - watch.lastPoll) / (watch.lastSteps - steps)
+        else:
+            remaining = self.minInterval
+        return min(self.maxInterval, max(self.minInterval, remaining / 2))
+    def __poll__(self, watch):
+        now = monotonic()
+        status = watch.kshd.status()
+        if (status.atPlus or status.atMinus) and not watch.atLimit:
+            for callback in self.limitCallbacks:
+                callback(watch.kshd, status)
+        watch.atLimit = bool(status.atPlus or status.atMinus)
+        if status.ready:
+            if self.readCoordinate:
+                watch.kshd.getCoordinate()
+            watch.future.set_result(status)
+            return True
+        steps = watch.kshd.getStepsToGo()
+        watch.due = now + self.__interval__(watch, steps, now)
+        watch.lastSteps = steps
+        watch.lastPoll = now
+        return False
+
+class KshdGroup(object):
+    """ Axes sharing one line moved together
+        Commands for all axes are prepared and validated first, then written back to back
+        in one write with Line.pollMany() and status replies are gathered afterwards.
+        lastSkew holds spread of reply arrival times of the last group command in seconds,
+        an upper estimate of start time difference between axes.
+    """
+    def __init__(self, axes):
+        self.axes = list(axes)
+        assert(self.axes)
+        line = self.axes[0].__piv__.__line__
+        for axis in self.axes:
+            assert(axis.__piv__.__line__ is line)
+        self.__line__ = line
+        self.lastSkew = None
+    def __send__(self, requests, priority=None):
+        """Returns Kshd.Status or exception instance per axis"""
+        arrivals = []
+        replies = self.__line__.pollMany(zip(self.axes, requests), priority=priority, arrivals=arrivals)
+        times = [t for t in arrivals if t is not None]
+        self.lastSkew = max(times) - min(times) if times else None
+        rv = []
+        for request, reply in zip(requests, replies):
+            if not isinstance(reply, Exception):
+                if len(reply) != 1:
+                    reply = BadPivRelpy("Invalid reply: %s for query: %s" % (str(reply), str(request)))
+                else:
+                    reply = Kshd.statuses[reply[0]]
+            rv.append(reply)
+        return rv
+    @staticmethod
+    def __check__(results):
+        for result in results:
+            if isinstance(result, Exception):
+                raise result
+        return results
+    def setSpeeds(self, speeds):
+        """Writes one Kshd.SpeedConf per axis and verifies they were stored"""
+        words = [speed.toWord() for speed in speeds]
+        assert(len(words) == len(self.axes))
+        statuses = KshdGroup.__check__(self.__send__([b'\x07' + word for word in words]))
+        readBack = self.__line__.pollMany([(axis, b'\x0E') for axis in self.axes])
+        for axis, word, check in zip(self.axes, words, KshdGroup.__check__(readBack)):
+            if check != word:
+                raise RuntimeError("Failed to write speed. Written: %s, read: %s" % (bytes(word).hex(), bytes(check).hex()))
+            axis.__remember__(speed=bytes(word).hex())
+        return statuses
+    def goWithSpeed(self, moves):
+        """ Starts (steps, stepTime) move on every axis
+            Returns list of Kshd.Status or exception instances for axes that failed to reply.
+        """
+        moves = [(int(steps), int(stepTime)) for steps, stepTime in moves]
+        assert(len(moves) == len(self.axes))
+        requests = [Kshd.goWithSpeedCommand.pack(0x11, steps, stepTime) for steps, stepTime in moves]
+        return self.__send__(requests)
+    def go(self, steps):
+        """Starts relative move on every axis, see goWithSpeed()"""
+        steps = [int(s) for s in steps]
+        assert(len(steps) == len(self.axes))
+        return self.__send__([Kshd.goCommand.pack(0x04, s) for s in steps])
+    def stop(self):
+        """Stops all axes, stop frames leave in a single write ahead of queued transactions"""
+        return self.__send__([b'\x08'] * len(self.axes), LineScheduler.URGENT)
+
+class TrajectoryReport(object):
+    """ Planned against achieved timing of an executed Trajectory, in seconds
+        achieved[i] runs from acknowledgement of segment i to acknowledgement of the next one,
+        or to observed end of motion for the last segment, so it includes the boundary gap.
+    """
+    def __init__(self):
+        self.planned = []
+        self.achieved = []
+        self.statuses = []
+        self.polls = 0
+    def gaps(self):
+        return [achieved - planned for planned, achieved in zip(self.planned, self.achieved)]
+    def plannedTotal(self):
+        return sum(self.planned)
+    def achievedTotal(self):
+        return sum(self.achieved)
+    def __repr__(self):
+        gaps = self.gaps()
+        return "motion.TrajectoryReport(segments=%d, planned=%.6f, achieved=%.6f, maxGap=%.6f, polls=%d)" % (
+            len(self.achieved), self.plannedTotal(), self.achievedTotal(), max(gaps) if gaps else 0., self.polls)
+
+class Trajectory(object):
+    """ Multi-segment move of a single Kshd axis
+        Segments are (steps, stepTime) pairs as for Kshd.goWithSpeed(), stepTime is in microseconds
+        per step. Segments with zero steps are dwells of stepTime microseconds.
+        goWithSpeed and getStepsToGo frames are encoded on construction. While a segment runs the axis is left alone
+        until shortly before its predicted end, then getStepsToGo() is polled with intervals predicted
+        from steps left, and next frame is sent as soon as controller reports no steps to go.
+        Poll round trip is measured and used as lead time of the first poll of each segment.
+    """
+    def __init__(self, kshd, segments, minInterval=timedelta(milliseconds=1)):
+        self.kshd = kshd
+        self.segments = [(int(steps), int(stepTime)) for steps, stepTime in segments]
+        self.minInterval = total_seconds(minInterval)
+        self.frames = [kshd.encode(Kshd.goWithSpeedCommand.pack(0x11, steps, stepTime)) if steps else None
+                       for steps, stepTime in self.segments]
+        self.__stepsToGo__ = kshd.encode(b'\x0C')
+        self.__pollTime__ = 0.
+    @staticmethod
+    def fromProfile(kshd, profile, minInterval=timedelta(milliseconds=1)):
+        """ Builds trajectory from velocity profile: sequence of (steps per second, timedelta)
+            Fractions of steps are carried over to the next segment, zero velocity is a dwell.
+        """
+        segments = []
+        carry = 0.
+        for velocity, duration in profile:
+            duration = total_seconds(duration)
+            if not velocity:
+                segments.append((0, int(round(duration * 1e6))))
+                continue
+            exact = velocity * duration + carry
+            steps = int(round(exact))
+            carry = exact - steps
+            if steps:
+                segments.append((steps, max(1, int(round(1e6 / abs(velocity))))))
+        return Trajectory(kshd, segments, minInterval)
+    def planned(self):
+        """Returns planned duration of every segment in seconds"""
+        return [(abs(steps) * stepTime if steps else stepTime) / 1e6 for steps, stepTime in self.segments]
+    def run(self, priority=None):
+        """Executes all segments, blocks until motion is over and returns TrajectoryReport"""
+        report = TrajectoryReport()
+        report.planned = self.planned()
+        started = None
+        for (steps, stepTime), frame, planned in zip(self.segments, self.frames, report.planned):
+            if frame is not None:
+                reply = self.kshd.queryFrame(frame, priority, idempotent=False, replyLength=1)
+                if len(reply) != 1:
+                    raise BadPivRelpy("Invalid reply: %s for segment: %d steps, %d us" % (str(reply), steps, stepTime))
+                report.statuses.append(Kshd.statuses[reply[0]])
+            now = monotonic()
+            if started is not None:
+                report.achieved.append(now - started)
+            started = now
+            if frame is None:
+                sleep(planned)
+            else:
+                self.__follow__(stepTime, started + planned, report, priority)
+        if started is not None:
+            report.achieved.append(monotonic() - started)
+        return report
+    def __follow__(self, stepTime, due, report, priority):
+        """Returns once the axis has no steps to go"""
+        wait = due - self.__pollTime__ - monotonic()
+        while True:
+            if wait > 0:
+                sleep(wait)
+            polled = monotonic()
+            left = Kshd.stepsReply.unpack(self.kshd.queryFrame(self.__stepsToGo__, priority, replyLength=4))[0]
+            self.__pollTime__ = monotonic() - polled
+            report.polls += 1
+            if not left:
+                return
+            wait = max(self.minInterval, left * stepTime / 1e6 - self.__pollTime__)
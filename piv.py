@@ -1,8 +1,11 @@
+import re
 from time import sleep
-from struct import pack, unpack
+from bisect import bisect_right
+from struct import Struct, unpack
 from datetime import timedelta
-import unittest 
-from .line import Line
+from .line import Line, LineBuffer, Timeout, deadlineAfter
+from .scheduler import LineScheduler
+from .retry import RttEstimator
 
 class PivError(RuntimeError):
     pass
@@ -17,10 +20,108 @@ class BadPivRelpy(PivError):
     pass
 
 def calcControl(data):
-    rv = 0
-    for b in data:
-        rv ^= b
-    return rv
+    """ XOR of all bytes
+        Long buffers are folded in bulk on a single integer, frame sized ones are cheaper to loop over.
+    """
+    width = len(data)
+    if width < 128:
+        rv = 0
+        for b in data:
+            rv ^= b
+        return rv
+    value = int.from_bytes(data, "little")
+    while width > 1:
+        half = (width + 1) // 2
+        value = (value >> (8 * half)) ^ (value & ((1 << (8 * half)) - 1))
+        width = half
+    return value
+
+class PivCodec(object):
+    """ Bulk PIV frame encoding and decoding
+        Escaping is done with bytes.replace() passes and precomputed tables instead of per-byte loops.
+        Frames without shift symbols are validated in place: XOR of body and control sum is 0.
+    """
+    start = b'\xaa'
+    stop = b'\xab'
+    shift = b'\xac'
+    escapes = ((shift, b'\xac\x02'), (start, b'\xac\x00'), (stop, b'\xac\x01'))
+    escapable = re.compile(b'[\xaa-\xac]')
+    singleBytes = tuple(bytes((b,)) for b in range(256))
+    unshifted = tuple(bytes((b + 0xAA,)) if b <= 0x55 else None for b in range(256))
+    @staticmethod
+    def encode(address, data):
+        assert(0 <= address < 256)
+        body = PivCodec.singleBytes[address] + data
+        body += PivCodec.singleBytes[calcControl(body)]
+        if PivCodec.escapable.search(body) is not None:
+            for symbol, escaped in PivCodec.escapes:
+                body = body.replace(symbol, escaped)
+        return PivCodec.start + body + PivCodec.stop
+    @staticmethod
+    def decodeFrame(data):
+        """ Unescapes and validates packet read up to stop symbol, returns address followed by payload
+            Anything preceding the last start symbol is discarded.
+        """
+        begin = data.rfind(PivCodec.start)
+        if begin >= 0:
+            data = data[begin + 1:]
+        if len(data) < 2:
+            raise BadPivPacket(("Piv packet is too short", data))
+        converted = data
+        if 0xAC in data: # shift, integer lookup is cheaper than bytes one
+            converted = PivCodec.unescape(data)
+        control = 0
+        for b in converted: # calcControl() inlined, frames are short
+            control ^= b
+        if control:
+            raise BadPivPacket(("Bad control sum", converted))
+        if len(converted) < 2:
+            raise BadPivPacket(("Piv packet is too short", data))
+        return converted[:-1]
+    @staticmethod
+    def unescape(data):
+        """ Replaces shift sequences of data with symbols they stand for
+            Sequences of start, stop and shift symbols are replaced in bulk, other shifted values
+            and invalid shifts are left to a per-sequence pass.
+        """
+        converted = data.replace(b'\xac\x00', b'\xaa').replace(b'\xac\x01', b'\xab')
+        shifts = converted.count(b'\xac')
+        if not shifts:
+            return converted
+        if shifts == converted.count(b'\xac\x02'):
+            return converted.replace(b'\xac\x02', b'\xac')
+        parts = data.split(PivCodec.shift)
+        last = len(parts) - 1
+        for i in range(1, len(parts)):
+            part = parts[i]
+            if not part:
+                if i == last:
+                    break
+                raise BadPivPacket(("Invalid shift", data))
+            b = PivCodec.unshifted[part[0]]
+            if b is None:
+                raise BadPivPacket(("Invalid shift", data))
+            parts[i] = b + part[1:]
+        return b"".join(parts)
+
+class PivDecoder(object):
+    """ Incremental PIV stream parser
+        feed() accepts chunks of arbitrary size, iteration yields validated frames
+        (address followed by payload) as soon as they are complete.
+        A bad frame raises BadPivPacket and is dropped, iteration can be resumed afterwards.
+    """
+    def __init__(self, highWater=65536):
+        self.__buffer__ = LineBuffer(min(4096, highWater), highWater)
+    def feed(self, chunk):
+        self.__buffer__.append(chunk)
+        return self
+    def __iter__(self):
+        return self
+    def __next__(self):
+        data = self.__buffer__.readline(PivCodec.stop)
+        if data is None:
+            raise StopIteration
+        return PivCodec.decodeFrame(data)
 
 class Piv(object):
     '''
@@ -31,68 +132,66 @@ class Piv(object):
     cshift = 0xAC
     escapedSymbols = (cstart, cstop, cshift)
     def __init__(self, line):
-        assert(isinstance(line, Line))
+        if not isinstance(line, Line):
+            from .asyncline import AsyncLine
+            assert(isinstance(line, AsyncLine))
         self.__line__ = line
         self.timeout = timedelta(seconds=1)
+        self.retryPolicy = None
+        self.__rtt__ = {}
         
     def send(self, address, data):
-        assert(isinstance(address, int))
-        assert(address >= 0)
-        assert(address < 256)
-        body = bytearray()
-        body.append(address)
-        body += data        
-
-        control = calcControl(body)
-        assert(control < 256)
-             
-        body.append(control)
-        buffer = bytearray()        
-        buffer.append(Piv.cstart)
-        for b in body:
-            assert(b >=0 and b < 256)
-            if b in Piv.escapedSymbols:
-                buffer.append(Piv.cshift)
-                buffer.append(b - Piv.cstart)
-            else:
-                buffer.append(b)
-        buffer.append(Piv.cstop)
-        self.__line__.write(buffer)
+        self.__line__.write(self.encode(address, data))
+    async def sendAsync(self, address, data):
+        await self.__line__.write(self.encode(address, data))
+    def encode(self, address, data):
+        return PivCodec.encode(address, data)
     eol = bytes([cstop])
     def receive(self, address):
         assert(isinstance(address, int))   
         data = self.__line__.readline(self.timeout, Piv.eol)
-        if len(data) < 2:
-            raise BadPivPacket(("Piv packet is too short", data))
-        converted = bytearray()
-        shifted = False
-        for b in data:
-            if b == Piv.cshift:
-                if shifted:
-                    raise BadPivPacket(("Invalid shift", data))
-                shifted = True
-                continue
-            if shifted:
-                if b + Piv.cstart > 255 or b in Piv.escapedSymbols:
-                    raise BadPivPacket(("Invalid shift", data))                    
-                b += Piv.cstart
-            shifted = False
-            assert(b >=0 and b < 256)
-            converted.append(b)
-        body = converted[0:-1]
-        control = calcControl(body)
-        if control != converted[-1]:
-            raise BadPivPacket(("Bad control sum", converted))
+        return self.decode(address, data)
+    async def receiveAsync(self, address):
+        data = await self.__line__.readline(self.timeout, Piv.eol)
+        return self.decode(address, data)
+    def decode(self, address, data):
+        assert(isinstance(address, int))
+        body = self.decodeFrame(data)
         if body[0] != address:
             raise BadPivPacket(("Invalid address", data))
         return body[1:]
-    def query(self, address, request):
-        self.__line__.lock.acquire()
-        try:
-            self.send(address, request)
-            return self.receive(address)
-        finally:
-            self.__line__.lock.release()
+    def decodeFrame(self, data):
+        """ Unescapes and validates packet, returns address followed by payload """
+        return PivCodec.decodeFrame(data)
+    def rtt(self, address):
+        """Returns response time estimator of module"""
+        estimator = self.__rtt__.get(address)
+        if estimator is None:
+            estimator = self.__rtt__[address] = RttEstimator()
+        return estimator
+    def query(self, address, request, priority=None, queueTimeout=None, idempotent=True, replyLength=None):
+        """ priority and queueTimeout are passed to Line.transact()
+            Requests which are not idempotent are never retried by retryPolicy.
+            replyLength is payload length of reply if known, it lets line read reply in bulk.
+        """
+        return self.queryFrame(address, self.encode(address, request), priority, queueTimeout, idempotent, replyLength)
+    def queryFrame(self, address, frame, priority=None, queueTimeout=None, idempotent=True, replyLength=None):
+        """ Same as query() for request frame prepared in advance with encode() """
+        expected = None if replyLength is None else replyLength + 4
+        def attempt(timeout):
+            deadline = deadlineAfter(timeout)
+            self.__line__.writeUntil(frame, deadline)
+            return self.decode(address, self.__line__.readlineUntil(deadline, Piv.eol, expected))
+        def transaction(line):
+            if self.retryPolicy is None:
+                return attempt(self.timeout)
+            return self.retryPolicy.run(line, self.rtt(address), self.timeout, attempt, idempotent, (Timeout, BadPivPacket))
+        return self.__line__.transact(transaction, priority, queueTimeout, address)
+    async def queryAsync(self, address, request):
+        """ Same as query() for asyncline.AsyncLine """
+        async with self.__line__.lock:
+            await self.sendAsync(address, request)
+            return await self.receiveAsync(address)
             
 
 class PivModule(object):
@@ -100,8 +199,27 @@ class PivModule(object):
         assert(isinstance(piv, Piv))
         self.__piv__ = piv
         self.__address__ = int(address)
-    def query(self, request):
-        return self.__piv__.query(self.__address__, request)
+    def query(self, request, priority=None, queueTimeout=None, idempotent=True, replyLength=None):
+        return self.__piv__.query(self.__address__, request, priority, queueTimeout, idempotent, replyLength)
+    def encode(self, request):
+        """Returns frame of request for queryFrame()"""
+        return self.__piv__.encode(self.__address__, request)
+    def queryFrame(self, frame, priority=None, queueTimeout=None, idempotent=True, replyLength=None):
+        return self.__piv__.queryFrame(self.__address__, frame, priority, queueTimeout, idempotent, replyLength)
+    async def queryAsync(self, request):
+        return await self.__piv__.queryAsync(self.__address__, request)
+    pollDelimiter = Piv.eol
+    @property
+    def timeout(self):
+        return self.__piv__.timeout
+    def pollRequest(self, request):
+        """ Returns request frame and reply key of query for Line.pollMany() """
+        return self.__piv__.encode(self.__address__, request), self.__address__
+    def pollMatch(self, data):
+        body = self.__piv__.decodeFrame(data)
+        return body[0], body[1:]
+    def pollReply(self, request, reply):
+        return reply
 
 def unpackBits(count, number):
     rv = []
@@ -117,29 +235,79 @@ def packBits(bits):
             rv |= (1 << (count - i -1))
     assert(count > 8 or rv < 256)
     return rv
-    
+
+def bitProperty(mask):
+    """Property of int subclass testing bits of mask, values are those of value & mask"""
+    return property(lambda self: self & mask)
+
 class Kshd(PivModule):
-    invalidCoordinate = unpack("!i", b'\x80\x00\x00\x00')
-    def __init__(self, piv, address):
+    invalidCoordinate = unpack("!i", b'\x80\x00\x00\x00')[0]
+    goCommand = Struct("!Bi")
+    goWithSpeedCommand = Struct("!BiI")
+    setCoordinateCommand = Struct("!Bi")
+    coordinateReply = Struct("!i")
+    stepsReply = Struct("!I")
+    speedWord = Struct("!HHH")
+    def __init__(self, piv, address, registry=None, validate=True):
+        """ Pass registry.ModuleRegistry to skip identification and coordinate read of known controllers """
         PivModule.__init__(self, piv, address)
-        data = self.query(b'\x01')
+        self.__registry__ = registry
+        self.lastCoordinate = 0
+        cached = self.__cached__()
+        if cached is not None and cached.get("type") == "Kshd":
+            self.lastCoordinate = cached.get("coordinate", 0)
+            if validate:
+                registry.validate(piv.__line__, self.__address__, lambda: self.identify(LineScheduler.BACKGROUND))
+            return
+        self.identify()
+        self.getCoordinate()
+        self.__remember__(type="Kshd")
+    def identify(self, priority=None):
+        data = self.query(b'\x01', priority)
         if data[0:2] != b'WS':
             raise BadPivModuleType(data)
-        self.getCoordinate()
-        self.lastCoordinate = 0
-    class Status(object):
-        def __init__(self, b):
-            b = int(b)
-            self.__b__ = b
-            rv = self
-            rv.ready = b & 1
-            rv.moving = b & 2
-            rv.atMinus = b & 4
-            rv.atPlus = b & 8
-            rv.atZero = b & 16
-            rv.exactSpeed = b & 32
+        return data
+    def __cached__(self):
+        if self.__registry__ is None:
+            return None
+        return self.__registry__.get(self.__piv__.__line__, self.__address__)
+    def __remember__(self, **fields):
+        if self.__registry__ is not None:
+            self.__registry__.update(self.__piv__.__line__, self.__address__, **fields)
+    def cachedConfiguration(self):
+        """Returns last known Configuration without bus transaction or None"""
+        cached = self.__cached__()
+        if cached is None or "configuration" not in cached:
+            return None
+        return Kshd.Configuration.fromWord(bytes.fromhex(cached["configuration"]))
+    def cachedSpeed(self):
+        """Returns last known SpeedConf without bus transaction or None"""
+        cached = self.__cached__()
+        if cached is None or "speed" not in cached:
+            return None
+        return Kshd.SpeedConf.fromWord(bytes.fromhex(cached["speed"]))
+    class Status(int):
+        """ Status byte, immutable, bits are tested on access
+            Use Kshd.statuses[b] to get shared instance instead of allocating one.
+            int() returns the byte, but like the former plain object a status is always true
+            and equal only to itself.
+        """
+        __slots__ = ()
+        __hash__ = object.__hash__
+        def __bool__(self):
+            return True
+        def __eq__(self, other):
+            return self is other
+        def __ne__(self, other):
+            return self is not other
+        ready = bitProperty(1)
+        moving = bitProperty(2)
+        atMinus = bitProperty(4)
+        atPlus = bitProperty(8)
+        atZero = bitProperty(16)
+        exactSpeed = bitProperty(32)
         def __repr__(self):
-            return "piv.Kshd.Status(0x%X)" % self.__b__
+            return "piv.Kshd.Status(0x%X)" % self
     class Configuration(object):
         """ Holds part of Kshd settings
             contains fields:
@@ -152,6 +320,7 @@ class Kshd(PivModule):
             zeroOpened, plusOpened, minusOpened (are True if corresponding pin switch is normally opened)
             half is True for 8-phase mode, False for 4-phase  
         """
+        __slots__ = ("moveCurrent", "holdCurrent", "holdDelay", "accLeave", "leaveK", "softK", "zeroOpened", "plusOpened", "minusOpened", "half")
         def __init__(self, moveCurrent=0, holdCurrent=0, holdDelay=0, accLeave=True, leaveK = False, softK=True, zeroOpened=True, plusOpened=True, minusOpened=True, half=True):
             self.moveCurrent, self.holdCurrent, self.holdDelay = map(float, (moveCurrent, holdCurrent, holdDelay))
             if self.holdDelay * 30 > 255:
@@ -162,45 +331,36 @@ class Kshd(PivModule):
         def codeToCurrent(code):
             code = int(code)
             if code < 0 or code > 7:
-                raise ValueError("Invalid current code: " + code)
+                raise ValueError("Invalid current code: %d" % code)
             return Kshd.Configuration.currentMap[code]
         @staticmethod
         def currentToCode(value):
-            currentMap = Kshd.Configuration.currentMap
+            """Returns code of the largest current not exceeding value"""
             value = float(value)
             if value < 0 or value > 3.5:
                 raise ValueError("Can't set current %f" % value)
-            if value == currentMap[len(currentMap)-1]:
-                return len(currentMap)-1
-            for code in range(len(currentMap)):
-                if currentMap[code] > value:
-                    return code - 1
-            raise ValueError("Can't set current %f" % value)
+            return bisect_right(Kshd.Configuration.currentMap, value) - 1
         @staticmethod
         def fromWord(word):
             assert(len(word)==4)
-            moveCurrent = Kshd.Configuration.codeToCurrent(word[0])
-            holdCurrent = Kshd.Configuration.codeToCurrent(word[1])
-            holdDelay = float(int(word[2]))/30.
-            cfg = int(word[3])
-            accLeave, leaveK, softK, zeroOpened, plusOpened, minusOpened, dummy, half = unpackBits(8, cfg)
-            if dummy:
+            currentMap = Kshd.Configuration.currentMap
+            if word[0] > 7 or word[1] > 7:
+                raise ValueError("Invalid current code: %d" % max(word[0], word[1]))
+            cfg = word[3]
+            if cfg & 2:
                 raise ValueError("Second bit of configuration word should always be zero: %02x" % cfg)
-            return Kshd.Configuration(moveCurrent, holdCurrent, holdDelay, accLeave, leaveK, softK, zeroOpened, plusOpened, minusOpened, half)
+            return Kshd.Configuration(currentMap[word[0]], currentMap[word[1]], word[2] / 30.,
+                                      cfg & 128, cfg & 64, cfg & 32, cfg & 16, cfg & 8, cfg & 4, cfg & 1)
         def toWord(self):
-            word = bytearray(4)
             currentToCode = Kshd.Configuration.currentToCode
-            word[0] = currentToCode(self.moveCurrent)
-            word[1] = currentToCode(self.holdCurrent)
-            word[2] = int(self.holdDelay * 30.)
-            cfg = packBits((self.accLeave, self.leaveK, self.softK, self.zeroOpened, self.plusOpened, self.minusOpened, False, self.half))
-            assert(cfg >= 0)
-            assert(cfg < 256)
-            word[3]=cfg
-            return word
+            cfg = 0
+            for flag in (self.accLeave, self.leaveK, self.softK, self.zeroOpened, self.plusOpened, self.minusOpened, False, self.half):
+                cfg = (cfg << 1) | bool(flag)
+            return bytearray((currentToCode(self.moveCurrent), currentToCode(self.holdCurrent), int(self.holdDelay * 30.), cfg))
         def __repr__(self):
             return "piv.Kshd.Configuration(moveCurrent=%f, holdCurrent=%f, holdDelay = %f, accLeave=%r, leaveK=%r, softK=%r, zeroOpened=%r, plusOpened=%r, minusOpened=%r, half=%r" % (self.moveCurrent, self.holdCurrent, self.holdDelay, self.accLeave, self.leaveK, self.softK, self.zeroOpened, self.plusOpened, self.minusOpened, self.half)
     class SpeedConf(object):
+        __slots__ = ("min", "max", "acc")
         def __init__(self, min, max, acc):
             self.min = int(min)
             self.max = int(max)
@@ -209,10 +369,10 @@ class Kshd(PivModule):
         @staticmethod
         def fromWord(word):
             assert(len(word)==6)
-            return Kshd.SpeedConf(*unpack("!HHH", word))
+            return Kshd.SpeedConf(*Kshd.speedWord.unpack(word))
         def toWord(self):
             self.__normalize__()
-            return pack("!HHH", self.min, self.max, self.acc)
+            return Kshd.speedWord.pack(self.min, self.max, self.acc)
         def __normalize__(self):
             if self.min < 32:
                 self.min=32
@@ -228,28 +388,33 @@ class Kshd(PivModule):
                 self.acc = 65535
         def __repr__(self): 
             return "piv.Kshd.SpeedConf(%d, %d, %d)" % (self.min, self.max, self.acc)
-    def __queryForStatus__(self, data):
-        reply = self.query(data)
+    def __queryForStatus__(self, data, priority=None, idempotent=True):
+        reply = self.query(data, priority, idempotent=idempotent, replyLength=1)
         if len(reply) != 1:
             raise BadPivRelpy("Invalid reply: %s for query: %s" % (str(reply), str(data)))
-        return Kshd.Status(reply[0])
+        return Kshd.statuses[reply[0]]
     def status(self):
         return self.__queryForStatus__(b'\x03')
-    def waitReady(self):
+    def waitReady(self, monitor=None):
+        """ Blocks until axis is ready
+            With motion.MotionMonitor polling is adaptive and shared with other axes.
+        """
+        if monitor is not None:
+            return monitor.watch(self).result()
         while(not self.status().ready):
             sleep(0.1)
             pass
     def goWithSpeed(self, steps, stepTime):        
-        return self.__queryForStatus__(b'\x11'+pack("!iI", steps, stepTime))
+        return self.__queryForStatus__(Kshd.goWithSpeedCommand.pack(0x11, steps, stepTime), idempotent=False)
     def stop(self):
-        return self.__queryForStatus__(b'\x08')
+        return self.__queryForStatus__(b'\x08', LineScheduler.URGENT)
     def getCoordinate(self):
         if not self.status().ready:
             return self.lastCoordinate
-        reply = self.query(b'\x14')
+        reply = self.query(b'\x14', replyLength=4)
         if len(reply)!=4:
             raise BadPivRelpy("Invalid position reply: "+str(reply))
-        rv = unpack("!i", reply)
+        rv = Kshd.coordinateReply.unpack(reply)
         if rv[0] == Kshd.invalidCoordinate:
             try:
                 self.setCoordinate(0)
@@ -257,31 +422,39 @@ class Kshd(PivModule):
                 pass
             raise BadPivRelpy("Invalid coordinate")
         self.lastCoordinate = rv[0]
+        self.__remember__(coordinate=rv[0])
         return rv[0]
     def setCoordinate(self, x):
-        return self.__queryForStatus__(b'\x13'+pack("!i", x))
+        return self.__queryForStatus__(Kshd.setCoordinateCommand.pack(0x13, x))
     def getStepsToGo(self):
-        reply = self.query(b'\x0C')
-        return unpack("!I", reply)[0]
+        reply = self.query(b'\x0C', replyLength=4)
+        return Kshd.stepsReply.unpack(reply)[0]
     def getConfiguration(self):
-        reply = self.query(b'\x0D')
+        reply = self.query(b'\x0D', replyLength=4)
         if len(reply) != 4:
             raise BadPivRelpy("Kshd configuration should be 4 bytes length: "+str(reply))
-        return Kshd.Configuration.fromWord(reply)
+        rv = Kshd.Configuration.fromWord(reply)
+        self.__remember__(configuration=bytes(reply).hex())
+        return rv
     def setConfiguration(self, conf):
         assert(isinstance(conf, Kshd.Configuration))
-        return self.__queryForStatus__(b'\x06'+conf.toWord())
+        word = conf.toWord()
+        rv = self.__queryForStatus__(b'\x06'+word)
+        self.__remember__(configuration=bytes(word).hex())
+        return rv
     def go(self, steps):
         steps = int(steps)
-        return self.__queryForStatus__(b'\x04'+pack("!i", steps))
+        return self.__queryForStatus__(Kshd.goCommand.pack(0x04, steps), idempotent=False)
     def freqEmit(self):
         self.__piv__.send(self.__address__, b'\x10')
     def getSpeed(self):
-        reply = self.query(b'\x0E')
+        reply = self.query(b'\x0E', replyLength=6)
         if len(reply)!=6:
             raise ValueError("Invalid speed reply: "+str(reply))
         try:
-            return Kshd.SpeedConf.fromWord(reply)
+            rv = Kshd.SpeedConf.fromWord(reply)
+            self.__remember__(speed=bytes(reply).hex())
+            return rv
         except ValueError:
             self.setSpeed(Kshd.SpeedConf(1000, 6000, 10000))
             raise
@@ -289,8 +462,10 @@ class Kshd(PivModule):
         assert(isinstance(speedConf, Kshd.SpeedConf))
         word = speedConf.toWord()
         rv = self.__queryForStatus__(b'\x07'+word)
-        check = self.query(b'\x0E')
+        check = self.query(b'\x0E', replyLength=6)
         if check != word:
-            raise RuntimeError("Failed to write speed. Written: %X, read: %X" % ())
+            raise RuntimeError("Failed to write speed. Written: %s, read: %s" % (bytes(word).hex(), bytes(check).hex()))
+        self.__remember__(speed=bytes(word).hex())
         return rv
-        
+
+Kshd.statuses = tuple(Kshd.Status(b) for b in range(256))
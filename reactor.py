@@ -0,0 +1,197 @@
+from collections import deque
+from concurrent.futures import Future, TimeoutError as FutureTimeout
+from selectors import DefaultSelector, EVENT_READ
+from socket import socketpair, timeout as socket_timeout
+from threading import RLock, Thread
+from time import monotonic_ns
+from .line import Timeout, BufferOverflow
+
+class ReactorEntry(object):
+    """Line attached to LineReactor"""
+    def __init__(self, line):
+        self.line = line
+        self.fd = None
+        self.pending = deque()
+
+class LineReactor(object):
+    """ Reads many lines from one thread with selectors (epoll where available)
+        Received bytes are put into line buffers and complete pending readline requests
+        as soon as their delimiters arrive. Attached lines keep the usual blocking API:
+        Line.readline() waits for the reactor instead of reading device itself, so
+        callers need no reader thread per gateway. readlineFuture() gives completion
+        based access for event loops (see asyncio.wrap_future()).
+        Lines should implement fileno() and readReady(), as SocketLine and SerialLine do.
+        PersistentSocket connections are re-registered after reconnect. Reactor never connects:
+        it reads with PersistentSocket.recvReady(), writers reconnect in their own threads.
+        Lock guards line buffers only, nothing waits for device while holding it.
+        Lock is reentrant: a connection lost inside readReady() notifies refresh() from reactor thread.
+        Line exceeding its buffer without delimiter fails its pending reads with BufferOverflow.
+    """
+    def __init__(self):
+        self.__selector__ = DefaultSelector()
+        self.__lock__ = RLock()
+        self.__entries__ = {}
+        self.__changed__ = set()
+        self.__closed__ = False
+        self.__wakeReader__, self.__wakeWriter__ = socketpair()
+        self.__wakeReader__.setblocking(False)
+        self.__wakeWriter__.setblocking(False)
+        self.__selector__.register(self.__wakeReader__, EVENT_READ, None)
+        self.__thread__ = Thread(target=self.__run__, name="LineReactor", daemon=True)
+        self.__thread__.start()
+    def attach(self, line):
+        with self.__lock__:
+            if self.__closed__:
+                raise RuntimeError("Reactor is closed")
+            assert(line.reactor is None)
+            self.__entries__[line] = ReactorEntry(line)
+            line.reactor = self
+        line.onDescriptorChange(lambda: self.refresh(line))
+        self.refresh(line)
+    def detach(self, line):
+        with self.__lock__:
+            entry = self.__entries__.pop(line, None)
+            if entry is None:
+                return
+            line.reactor = None
+            self.__changed__.add(entry)
+        self.__wake__()
+        self.__fail__(entry, Timeout("Line detached from reactor"))
+    def refresh(self, line):
+        """Makes reactor register current descriptor of line"""
+        with self.__lock__:
+            entry = self.__entries__.get(line)
+            if entry is None:
+                return
+            self.__changed__.add(entry)
+        self.__wake__()
+    def readlineFuture(self, line, delimiter=b'\r'):
+        """Returns concurrent.futures.Future resolved with next non-empty line of attached line"""
+        future = Future()
+        with self.__lock__:
+            entry = self.__entries__[line]
+            if not entry.pending:
+                reply = LineReactor.__nextLine__(line, delimiter)
+                if reply is not None:
+                    future.set_result(reply)
+                    return future
+            entry.pending.append((delimiter, future))
+        return future
+    def readline(self, line, deadline, delimiter=b'\r'):
+        """Blocks until next non-empty line or deadline (monotonic_ns() value)"""
+        future = self.readlineFuture(line, delimiter)
+        try:
+            return future.result(max(0, deadline - monotonic_ns()) / 1e9)
+        except FutureTimeout:
+            pass
+        with self.__lock__:
+            if not future.done():
+                entry = self.__entries__.get(line)
+                if entry is not None:
+                    entry.pending.remove((delimiter, future))
+                future.cancel()
+                raise Timeout("Line read timeout. Data read so far: " + str(bytes(line.__buffer__)))
+        return future.result()
+    def discard(self, line):
+        with self.__lock__:
+            line.__buffer__.clear()
+    def close(self):
+        with self.__lock__:
+            self.__closed__ = True
+            entries = list(self.__entries__.values())
+            self.__entries__.clear()
+        self.__wake__()
+        self.__thread__.join()
+        for entry in entries:
+            entry.line.reactor = None
+            self.__fail__(entry, Timeout("Reactor is closed"))
+        self.__selector__.close()
+        self.__wakeReader__.close()
+        self.__wakeWriter__.close()
+    @staticmethod
+    def __nextLine__(line, delimiter):
+        buffer = line.__buffer__
+        while True:
+            reply = buffer.readline(delimiter)
+            if reply != b'':
+                return reply
+    def __fail__(self, entry, error):
+        with self.__lock__:
+            pending, entry.pending = entry.pending, deque()
+        for delimiter, future in pending:
+            if not future.done():
+                future.set_exception(error)
+    def __wake__(self):
+        try:
+            self.__wakeWriter__.send(b'\0')
+        except BlockingIOError:
+            pass
+    def __register__(self, entry):
+        """ Registers current descriptor of entry again, runs in reactor thread
+            Registration is renewed even for the same number, as a closed descriptor
+            is silently dropped by epoll and its number reused by the next connection.
+        """
+        attached = entry.line.reactor is self
+        fd = None
+        if attached:
+            try:
+                fd = entry.line.fileno()
+            except OSError:
+                fd = None
+        if entry.fd is not None:
+            try:
+                self.__selector__.unregister(entry.fd)
+            except (KeyError, ValueError):
+                pass
+        entry.fd = None
+        if fd is not None:
+            try:
+                self.__selector__.register(fd, EVENT_READ, entry)
+                entry.fd = fd
+            except (OSError, ValueError):
+                pass
+    def __service__(self, entry):
+        """Reads ready line and completes pending requests, runs in reactor thread"""
+        line = entry.line
+        completed = []
+        with self.__lock__:
+            if entry.fd is None or line.fileno() != entry.fd:
+                return
+            try:
+                count = line.readReady()
+            except (BlockingIOError, InterruptedError, socket_timeout):
+                return
+            except BufferOverflow as e:
+                self.__fail__(entry, e)
+                return
+            except OSError:
+                count = 0
+            while entry.pending:
+                delimiter, future = entry.pending[0]
+                reply = LineReactor.__nextLine__(line, delimiter)
+                if reply is None:
+                    break
+                entry.pending.popleft()
+                completed.append((future, reply))
+        if not count and entry.fd is not None:
+            self.__selector__.unregister(entry.fd)
+            entry.fd = None
+        for future, reply in completed:
+            future.set_result(reply)
+    def __run__(self):
+        while True:
+            with self.__lock__:
+                if self.__closed__:
+                    return
+                changed, self.__changed__ = self.__changed__, set()
+            for entry in changed:
+                self.__register__(entry)
+            for key, mask in self.__selector__.select():
+                if key.data is None:
+                    try:
+                        while self.__wakeReader__.recv(4096):
+                            pass
+                    except BlockingIOError:
+                        pass
+                    continue
+                self.__service__(key.data)
@@ -0,0 +1,203 @@
+""" Time series recording of polled module values
+    Recorder keeps samples in array columns: int64 timestamp (ns since epoch), uint16 source id
+    and float64 value, 18 bytes per sample, and appends them in chunks to a binary file.
+    File is a sequence of chunks: header (magic, count, first and last timestamp) followed
+    by timestamp, value and source id columns in native byte order.
+    Source names are kept next to it in path + ".names" as JSON list indexed by id.
+    RecordFile reads recordings back with range queries over memory mapped file.
+"""
+import json
+import os
+from array import array
+from bisect import bisect_left
+from heapq import heappush, heappop
+from itertools import count
+from mmap import mmap, ACCESS_READ
+from struct import Struct
+from threading import Condition, Lock, Thread
+from time import monotonic_ns, time_ns
+from .line import nanoseconds
+
+chunkHeader = Struct("=4sIqq")
+magic = b'RSR1'
+sampleSize = 8 + 8 + 2
+
+def loadNames(path):
+    if path is None or not os.path.exists(path + ".names"):
+        return []
+    with open(path + ".names") as f:
+        return json.load(f)
+
+class Recorder(object):
+    """ Samples module reads on schedule into compact columns
+        Columns are appended to path every chunkSize samples and on flush() and close().
+        Timestamps of a recording never decrease, so they can be searched by bisection.
+    """
+    def __init__(self, path=None, chunkSize=4096):
+        self.path = path
+        self.chunkSize = chunkSize
+        self.times = array('q')
+        self.ids = array('H')
+        self.values = array('d')
+        self.names = loadNames(path)
+        self.samples = 0
+        self.errors = 0
+        self.__ids__ = dict((name, i) for i, name in enumerate(self.names))
+        self.__last__ = 0
+        self.__lock__ = Lock()
+        self.__flushLock__ = Lock()
+        self.__condition__ = Condition()
+        self.__schedule__ = []
+        self.__sequence__ = count()
+        self.__closed__ = False
+        self.__thread__ = None
+    def source(self, name):
+        """Returns id of named source, registering new names"""
+        with self.__lock__:
+            id = self.__ids__.get(name)
+            if id is not None:
+                return id
+            id = self.__ids__[name] = len(self.names)
+            assert(id < 65536)
+            self.names.append(name)
+            names = list(self.names)
+        if self.path is not None:
+            with open(self.path + ".names.tmp", "w") as f:
+                json.dump(names, f)
+            os.replace(self.path + ".names.tmp", self.path + ".names")
+        return id
+    def add(self, name, read, interval):
+        """ Samples float(read()) every interval (timedelta) from recorder thread
+            For example: recorder.add("x", kshd.getCoordinate, timedelta(milliseconds=100))
+            or recorder.add("status", lambda: int(kshd.status()), timedelta(seconds=1)).
+            Failed reads are counted in errors.
+        """
+        id = self.source(name)
+        with self.__condition__:
+            if self.__closed__:
+                raise RuntimeError("Recorder is closed")
+            heappush(self.__schedule__, (monotonic_ns(), next(self.__sequence__), id, read, nanoseconds(interval)))
+            if self.__thread__ is None:
+                self.__thread__ = Thread(target=self.__run__, name="Recorder", daemon=True)
+                self.__thread__.start()
+            self.__condition__.notify()
+        return id
+    def sample(self, id, value):
+        """Records value of source id with current time"""
+        with self.__lock__:
+            t = self.__last__ = max(time_ns(), self.__last__)
+            self.times.append(t)
+            self.ids.append(id)
+            self.values.append(value)
+            self.samples += 1
+            full = len(self.times) >= self.chunkSize
+        if full and self.path is not None:
+            self.flush()
+    def flush(self):
+        """Appends recorded columns to file and empties them"""
+        with self.__flushLock__:
+            with self.__lock__:
+                times, ids, values = self.times, self.ids, self.values
+                if not times or self.path is None:
+                    return
+                self.times, self.ids, self.values = array('q'), array('H'), array('d')
+            with open(self.path, "ab") as f:
+                f.write(chunkHeader.pack(magic, len(times), times[0], times[-1]))
+                times.tofile(f)
+                values.tofile(f)
+                ids.tofile(f)
+    def close(self):
+        with self.__condition__:
+            self.__closed__ = True
+            self.__condition__.notify()
+        if self.__thread__ is not None:
+            self.__thread__.join()
+        self.flush()
+    def __run__(self):
+        while True:
+            with self.__condition__:
+                while True:
+                    if self.__closed__:
+                        return
+                    if self.__schedule__:
+                        wait = self.__schedule__[0][0] - monotonic_ns()
+                        if wait <= 0:
+                            due, sequence, id, read, interval = heappop(self.__schedule__)
+                            break
+                        self.__condition__.wait(wait / 1e9)
+                    else:
+                        self.__condition__.wait()
+            try:
+                value = float(read())
+            except Exception:
+                self.errors += 1
+            else:
+                self.sample(id, value)
+            due = max(due + interval, monotonic_ns())
+            with self.__condition__:
+                heappush(self.__schedule__, (due, sequence, id, read, interval))
+
+class RecordFile(object):
+    """ Recorder file opened for analysis
+        Chunks are indexed on open, samples within chunks are located by bisection
+        of memory mapped timestamp column. Incomplete trailing chunk is ignored.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.names = loadNames(path)
+        self.chunks = []
+        self.__file__ = open(path, "rb")
+        size = os.fstat(self.__file__.fileno()).st_size
+        self.__map__ = mmap(self.__file__.fileno(), 0, access=ACCESS_READ) if size else None
+        offset = 0
+        while offset + chunkHeader.size <= size:
+            mark, samples, first, last = chunkHeader.unpack_from(self.__map__, offset)
+            if mark != magic:
+                raise ValueError("Bad chunk header at offset %d of %s" % (offset, path))
+            end = offset + chunkHeader.size + samples * sampleSize
+            if end > size:
+                break
+            self.chunks.append((offset + chunkHeader.size, samples, first, last))
+            offset = end
+    def __len__(self):
+        return sum(chunk[1] for chunk in self.chunks)
+    def id(self, name):
+        return self.names.index(name)
+    def query(self, start=None, end=None, source=None):
+        """ Returns (times, ids, values) arrays of samples with start <= time < end
+            Times are nanoseconds since epoch, source limits result to one source name or id.
+        """
+        times, ids, values = array('q'), array('H'), array('d')
+        if isinstance(source, str):
+            source = self.id(source)
+        for base, samples, first, last in self.chunks:
+            if start is not None and last < start:
+                continue
+            if end is not None and first >= end:
+                break
+            idBase = base + 16 * samples
+            with memoryview(self.__map__) as view, view[base:base + 8 * samples].cast('q') as column:
+                low = 0 if start is None else bisect_left(column, start)
+                high = samples if end is None else bisect_left(column, end)
+            if source is None:
+                times.frombytes(self.__map__[base + 8 * low:base + 8 * high])
+                values.frombytes(self.__map__[base + 8 * (samples + low):base + 8 * (samples + high)])
+                ids.frombytes(self.__map__[idBase + 2 * low:idBase + 2 * high])
+                continue
+            chunkIds = array('H', self.__map__[idBase + 2 * low:idBase + 2 * high])
+            chunkTimes = array('q', self.__map__[base + 8 * low:base + 8 * high])
+            chunkValues = array('d', self.__map__[base + 8 * (samples + low):base + 8 * (samples + high)])
+            for i, id in enumerate(chunkIds):
+                if id == source:
+                    times.append(chunkTimes[i])
+                    ids.append(id)
+                    values.append(chunkValues[i])
+        return times, ids, values
+    def numpy(self, start=None, end=None, source=None):
+        """Same as query() returning NumPy arrays, requires NumPy"""
+        import numpy
+        return tuple(numpy.frombuffer(column, dtype=column.typecode) for column in self.query(start, end, source))
+    def close(self):
+        if self.__map__ is not None:
+            self.__map__.close()
+        self.__file__.close()
@@ -0,0 +1,114 @@
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from threading import Lock
+from .adam import AdamModule, AdamError
+from .piv import Piv, PivModule, PivError
+from .line import Timeout
+
+class ModuleRegistry(object):
+    """ Remembers identity and configuration of modules per (line name, address)
+        Module constructors accepting registry argument skip identification round trips
+        for known modules and confirm cached identity in background.
+        Lines without name are keyed by object identity and can't be saved.
+    """
+    def __init__(self, path=None):
+        self.path = path
+        self.errors = []
+        self.__entries__ = {}
+        self.__lock__ = Lock()
+        self.__validator__ = None
+        if path is not None and os.path.exists(path):
+            self.load()
+    @staticmethod
+    def key(line, address):
+        name = line.name
+        if name is None:
+            name = id(line)
+        elif not isinstance(name, str):
+            name = ":".join(map(str, name))
+        return (name, int(address))
+    def get(self, line, address):
+        """Returns copy of cached fields of module or None"""
+        with self.__lock__:
+            entry = self.__entries__.get(ModuleRegistry.key(line, address))
+            if entry is None:
+                return None
+            return dict(entry)
+    def update(self, line, address, **fields):
+        with self.__lock__:
+            self.__entries__.setdefault(ModuleRegistry.key(line, address), {}).update(fields)
+    def forget(self, line, address):
+        with self.__lock__:
+            self.__entries__.pop(ModuleRegistry.key(line, address), None)
+    def validate(self, line, address, check):
+        """ Runs check() in background, forgets module if it raises
+            Exceptions are collected in errors list.
+        """
+        with self.__lock__:
+            if self.__validator__ is None:
+                self.__validator__ = ThreadPoolExecutor(1, "ModuleRegistry")
+            validator = self.__validator__
+        def run():
+            try:
+                check()
+            except Exception as e:
+                self.forget(line, address)
+                self.errors.append((ModuleRegistry.key(line, address), e))
+        return validator.submit(run)
+    def wait(self):
+        """Waits for background validation to complete"""
+        with self.__lock__:
+            validator, self.__validator__ = self.__validator__, None
+        if validator is not None:
+            validator.shutdown()
+    def save(self, path=None):
+        path = path or self.path
+        with self.__lock__:
+            entries = [{"line": name, "address": address, "fields": fields}
+                       for (name, address), fields in self.__entries__.items() if isinstance(name, str)]
+        with open(path + ".tmp", "w") as f:
+            json.dump(entries, f, indent=1)
+        os.replace(path + ".tmp", path)
+    def load(self, path=None):
+        path = path or self.path
+        with open(path) as f:
+            entries = json.load(f)
+        with self.__lock__:
+            for entry in entries:
+                self.__entries__[(entry["line"], entry["address"])] = entry["fields"]
+
+def probeAdam(lines, addresses):
+    """Pipelined identification query for ADAM modules"""
+    return [(AdamModule(line, address), "M") for line in lines for address in addresses]
+
+def probeKshd(lines, addresses):
+    """Pipelined identification query for PIV motor controllers"""
+    return [(PivModule(Piv(line), address), b'\x01') for line in lines for address in addresses]
+
+def discover(lines, addresses, probe=probeAdam, registry=None, timeout=timedelta(milliseconds=200)):
+    """ Scans address range of every line concurrently
+        Each line is scanned from its own thread with a single Line.pollMany() batch,
+        so an address range costs about one timeout per line instead of one per address.
+        Returns dict {(line name, address): identification reply}, records found modules in registry.
+    """
+    lines = list(lines)
+    addresses = list(addresses)
+    def scan(line):
+        batch = probe([line], addresses)
+        return batch, line.pollMany(batch, timeout)
+    found = {}
+    with ThreadPoolExecutor(max(1, len(lines))) as executor:
+        for line, (batch, results) in zip(lines, executor.map(scan, lines)):
+            for (module, command), address, result in zip(batch, addresses, results):
+                if isinstance(result, (Timeout, AdamError, PivError)):
+                    continue
+                if isinstance(module, PivModule):
+                    if result[0:2] != b'WS':
+                        continue
+                    result = "Kshd"
+                found[ModuleRegistry.key(line, address)] = result
+                if registry is not None:
+                    registry.update(line, address, type=result)
+    return found
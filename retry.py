@@ -0,0 +1,67 @@
+from datetime import timedelta
+from time import monotonic
+from .line import Timeout, total_seconds
+
+class RttEstimator(object):
+    """ Smoothed response time of a module, computed as TCP does (RFC 6298)
+        Timeout is the smoothed round trip time plus k deviations.
+    """
+    def __init__(self, alpha=1/8., beta=1/4., k=4):
+        self.alpha = alpha
+        self.beta = beta
+        self.k = k
+        self.srtt = None
+        self.rttvar = None
+    def sample(self, seconds):
+        if self.srtt is None:
+            self.srtt = seconds
+            self.rttvar = seconds / 2.
+            return
+        self.rttvar = (1 - self.beta) * self.rttvar + self.beta * abs(self.srtt - seconds)
+        self.srtt = (1 - self.alpha) * self.srtt + self.alpha * seconds
+    def backoff(self):
+        """Widens timeout after a lost reply"""
+        if self.rttvar is not None:
+            self.rttvar *= 2
+    def timeout(self, minimum, maximum):
+        """Returns timeout in seconds, maximum while there are no samples"""
+        if self.srtt is None:
+            return maximum
+        return min(maximum, max(minimum, self.srtt + self.k * self.rttvar))
+
+class RetryPolicy(object):
+    """ Retries failed request-reply exchanges with adaptive timeouts
+        Idempotent requests are attempted up to attempts times with timeout derived from
+        module response times. Other requests are sent once and wait for the full timeout,
+        as their effect can't be told from a lost reply.
+        Stale input is discarded from the line before each retry.
+    """
+    def __init__(self, attempts=3, minTimeout=timedelta(milliseconds=20), adaptive=True):
+        assert(attempts >= 1)
+        self.attempts = attempts
+        self.minTimeout = minTimeout
+        self.adaptive = adaptive
+        self.retries = 0
+    def run(self, line, estimator, maxTimeout, attempt, idempotent=True, errors=(Timeout,)):
+        """ Calls attempt(timeout) until it returns without raising one of errors
+            attempt should perform single exchange on line, which should already be locked
+        """
+        assert(isinstance(maxTimeout, timedelta))
+        tries = self.attempts if idempotent else 1
+        for i in range(tries):
+            timeout = maxTimeout
+            if i:
+                self.retries += 1
+                line.discard()
+            if idempotent and self.adaptive:
+                timeout = timedelta(seconds=estimator.timeout(total_seconds(self.minTimeout), total_seconds(maxTimeout)))
+            started = monotonic()
+            try:
+                rv = attempt(timeout)
+            except errors:
+                estimator.backoff()
+                if i == tries - 1:
+                    raise
+                continue
+            estimator.sample(monotonic() - started)
+            return rv
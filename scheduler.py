@@ -0,0 +1,99 @@
+from datetime import timedelta
+from heapq import heappush, heappop
+from itertools import count
+from threading import Condition, Thread, current_thread
+from time import monotonic_ns
+from .line import DeadlineExpired, nanoseconds
+
+class LineScheduler(object):
+    """ Serializes transactions of a line in priority order
+        Once created, Line.transact() submits to scheduler and waits for result.
+        Smaller priority value is served first, equal priorities are served in submission order.
+    """
+    URGENT = 0
+    NORMAL = 10
+    BACKGROUND = 20
+    def __init__(self, line):
+        self.__line__ = line
+        self.__queue__ = []
+        self.__sequence__ = count()
+        self.__condition__ = Condition()
+        self.__closed__ = False
+        self.executed = 0
+        self.expired = 0
+        self.__lastWait__ = 0
+        self.__maxWait__ = 0
+        self.__totalWait__ = 0
+        self.__thread__ = Thread(target=self.__run__, name="LineScheduler", daemon=True)
+        self.__thread__.start()
+        line.scheduler = self
+    def submit(self, action, priority=None, queueTimeout=None):
+        """ Queues action(line) for exclusive execution
+            queueTimeout is a timedelta, job is dropped with DeadlineExpired if not started within it
+            Returns concurrent.futures.Future holding action result
+        """
+        if priority is None:
+            priority = LineScheduler.NORMAL
+        submitted = monotonic_ns()
+        expires = None
+        if queueTimeout is not None:
+            assert(isinstance(queueTimeout, timedelta))
+            expires = submitted + nanoseconds(queueTimeout)
+        from concurrent.futures import Future
+        future = Future()
+        with self.__condition__:
+            if self.__closed__:
+                raise RuntimeError("Scheduler is closed")
+            heappush(self.__queue__, (priority, next(self.__sequence__), submitted, expires, action, future))
+            self.__condition__.notify()
+        return future
+    def isWorker(self):
+        """True when called from within a scheduled transaction"""
+        return current_thread() is self.__thread__
+    def queueDepth(self):
+        return len(self.__queue__)
+    @property
+    def lastWait(self):
+        return timedelta(microseconds=self.__lastWait__ // 1000)
+    @property
+    def maxWait(self):
+        return timedelta(microseconds=self.__maxWait__ // 1000)
+    def meanWait(self):
+        if not self.executed:
+            return timedelta(0)
+        return timedelta(microseconds=self.__totalWait__ // self.executed // 1000)
+    def close(self):
+        """Stops accepting transactions, lets queued ones run and detaches from line"""
+        with self.__condition__:
+            self.__closed__ = True
+            self.__condition__.notify()
+        self.__thread__.join()
+        if self.__line__.scheduler is self:
+            self.__line__.scheduler = None
+    def __run__(self):
+        while True:
+            with self.__condition__:
+                while not self.__queue__ and not self.__closed__:
+                    self.__condition__.wait()
+                if not self.__queue__:
+                    return
+                priority, sequence, submitted, expires, action, future = heappop(self.__queue__)
+            if not future.set_running_or_notify_cancel():
+                continue
+            now = monotonic_ns()
+            waited = now - submitted
+            if expires is not None and now > expires:
+                self.expired += 1
+                future.set_exception(DeadlineExpired("Transaction dropped after waiting %.3f s in queue" % (waited / 1e9)))
+                continue
+            self.executed += 1
+            self.__lastWait__ = waited
+            self.__maxWait__ = max(self.__maxWait__, waited)
+            self.__totalWait__ += waited
+            try:
+                with self.__line__.lock:
+                    result = action(self.__line__)
+            except BaseException as e:
+                future.set_exception(e)
+            else:
+                future.set_result(result)
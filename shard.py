@@ -0,0 +1,231 @@
+""" Sharding of independent lines across worker processes
+    ShardSupervisor starts workers, each owning a subset of lines and running their transactions
+    with busd.BusExecutor, so per-byte protocol work of different lines runs on different cores.
+    Requests travel to workers over pipes in busd request format, results come back through
+    SharedRing, a single producer single consumer ring buffer in shared memory.
+    Pass supervisor.line(name) to busd Remote* classes to talk to modules without knowing the owner:
+        def gateway1():
+            return SocketLine(PersistentSocket(("10.0.0.5", 4001)))
+        supervisor = ShardSupervisor({"gw1": gateway1, ...})
+        relays = RemoteAdam4068(supervisor.line("gw1"), 1)
+    Factories are pickled to workers, so they should be module level functions.
+"""
+import multiprocessing
+from concurrent.futures import Future
+from itertools import count
+from multiprocessing.shared_memory import SharedMemory
+from queue import Queue
+from struct import Struct
+from threading import Lock, Thread
+from time import sleep
+from .busd import BusExecutor, RemoteLine, request, encodeRequest, encodeError, decodeReply, OK, ERROR
+
+message = Struct("=IB")
+
+class SharedRing(object):
+    """ Single producer single consumer ring of byte records over SharedMemory
+        Header holds head and tail byte counters, written only by consumer and producer respectively,
+        and capacity, as the segment opened by name may be rounded up to page size.
+        Records are 8 byte aligned: length followed by data, a WRAP length skips to ring start.
+        Producer waits while ring is full. Readiness should be signalled separately,
+        for example with a semaphore released after put().
+    """
+    header = Struct("=QQQ")
+    counters = Struct("=QQ")
+    counter = Struct("=Q")
+    length = Struct("=I")
+    WRAP = 0xFFFFFFFF
+    def __init__(self, name=None, size=1 << 20):
+        if name is None:
+            assert(size % 8 == 0)
+            self.memory = SharedMemory(create=True, size=SharedRing.header.size + size)
+            SharedRing.header.pack_into(self.memory.buf, 0, 0, 0, size)
+        else:
+            self.memory = SharedMemory(name=name)
+        self.name = self.memory.name
+        self.capacity = SharedRing.header.unpack_from(self.memory.buf, 0)[2]
+        self.__data__ = self.memory.buf[SharedRing.header.size:SharedRing.header.size + self.capacity]
+    def put(self, data):
+        size = (SharedRing.length.size + len(data) + 7) & ~7
+        if size > self.capacity:
+            raise ValueError("Record of %d bytes doesn't fit ring of %d bytes" % (len(data), self.capacity))
+        buf = self.memory.buf
+        while True:
+            head, tail = SharedRing.counters.unpack_from(buf, 0)
+            position = tail % self.capacity
+            skip = self.capacity - position if position + size > self.capacity else 0
+            if tail + skip + size - head <= self.capacity:
+                break
+            sleep(0.0001)
+        if skip:
+            SharedRing.length.pack_into(self.__data__, position, SharedRing.WRAP)
+            position = 0
+        SharedRing.length.pack_into(self.__data__, position, len(data))
+        start = position + SharedRing.length.size
+        self.__data__[start:start + len(data)] = data
+        SharedRing.counter.pack_into(buf, 8, tail + skip + size)
+    def get(self):
+        """Returns oldest record or None when ring is empty"""
+        buf = self.memory.buf
+        head, tail = SharedRing.counters.unpack_from(buf, 0)
+        if head == tail:
+            return None
+        position = head % self.capacity
+        length = SharedRing.length.unpack_from(self.__data__, position)[0]
+        if length == SharedRing.WRAP:
+            head += self.capacity - position
+            position = 0
+            length = SharedRing.length.unpack_from(self.__data__, position)[0]
+        start = position + SharedRing.length.size
+        data = bytes(self.__data__[start:start + length])
+        SharedRing.counter.pack_into(buf, 0, head + ((SharedRing.length.size + length + 7) & ~7))
+        return data
+    def close(self):
+        self.__data__.release()
+        self.memory.close()
+    def unlink(self):
+        self.memory.unlink()
+
+def serveShard(factories, requests, ringName, ready):
+    """ Worker process entry: builds lines from factories and runs requests until an empty message
+        or supervisor exit. Every line gets its own thread, so lines of one worker don't wait for each other.
+    """
+    ring = SharedRing(ringName)
+    executor = BusExecutor(dict((name, factory()) for name, factory in factories.items()))
+    lock = Lock()
+    def reply(id, code, payload):
+        with lock:
+            ring.put(message.pack(id, code) + payload)
+        ready.release()
+    def serveLine(queue):
+        while True:
+            item = queue.get()
+            if item is None:
+                return
+            id, code, payload = item
+            try:
+                result = executor.execute(code, payload)
+            except Exception as e:
+                reply(id, ERROR, encodeError(e))
+            else:
+                reply(id, OK, result)
+    queues = {}
+    threads = []
+    for name in executor.lines:
+        queues[name] = Queue()
+        threads.append(Thread(target=serveLine, args=(queues[name],), name="Shard " + name, daemon=True))
+        threads[-1].start()
+    parent = multiprocessing.parent_process()
+    while True:
+        try:
+            if not requests.poll(0.5):
+                if parent is not None and not parent.is_alive():
+                    break
+                continue
+            data = requests.recv_bytes()
+        except EOFError:
+            break
+        if not data:
+            break
+        id, code = message.unpack_from(data)
+        payload = data[message.size:]
+        name = bytes(payload[request.size:request.size + payload[0]]).decode("utf-8")
+        queue = queues.get(name)
+        if queue is None:
+            reply(id, ERROR, encodeError(KeyError("Unknown line: " + name)))
+            continue
+        queue.put((id, code, payload))
+    for queue in queues.values():
+        queue.put(None)
+    for thread in threads:
+        thread.join()
+    ring.close()
+
+class ShardWorker(object):
+    """Supervisor side of a worker process"""
+    def __init__(self, names):
+        self.names = names
+        self.process = None
+        self.requests = None
+        self.ring = None
+        self.ready = None
+        self.collector = None
+        self.lock = Lock()
+
+class ShardSupervisor(object):
+    """ Distributes lines over worker processes and routes requests to their owners
+        lines is a dict {name: factory}, factory is a picklable callable returning Line,
+        called in the worker, as open sockets and ports can't be moved between processes.
+        Lines are assigned round-robin in name order to at most workers processes.
+        call() has the signature of busd.BusClient.call(), so RemoteLine and busd Remote* modules work unchanged.
+    """
+    def __init__(self, lines, workers=None, ringSize=1 << 20, context=None):
+        names = sorted(lines)
+        assert(names)
+        if workers is None:
+            workers = multiprocessing.cpu_count()
+        workers = max(1, min(workers, len(names)))
+        context = context or multiprocessing.get_context()
+        self.owners = {}
+        self.workers = [ShardWorker(names[i::workers]) for i in range(workers)]
+        self.__pending__ = {}
+        self.__lock__ = Lock()
+        self.__ids__ = count(1)
+        self.__closed__ = False
+        for worker in self.workers:
+            for name in worker.names:
+                self.owners[name] = worker
+            worker.ring = SharedRing(size=ringSize)
+            worker.ready = context.Semaphore(0)
+            receiver, worker.requests = context.Pipe(duplex=False)
+            factories = dict((name, lines[name]) for name in worker.names)
+            worker.process = context.Process(target=serveShard, args=(factories, receiver, worker.ring.name, worker.ready),
+                                             name="Shard %s" % ",".join(worker.names), daemon=True)
+            worker.process.start()
+            receiver.close()
+            worker.collector = Thread(target=self.__collect__, args=(worker,), name="ShardCollector", daemon=True)
+            worker.collector.start()
+    def submit(self, code, name, address, timeout, data, priority=None, flags=0):
+        """Returns concurrent.futures.Future of (reply code, payload) for request"""
+        worker = self.owners[name]
+        future = Future()
+        with self.__lock__:
+            if self.__closed__:
+                raise RuntimeError("Shard supervisor is closed")
+            id = next(self.__ids__) & 0xFFFFFFFF
+            self.__pending__[id] = (worker, future)
+        with worker.lock:
+            worker.requests.send_bytes(message.pack(id, code) + encodeRequest(code, name, address, timeout, data, priority, flags))
+        return future
+    def call(self, code, name, address, timeout, data, priority=None, flags=0):
+        return decodeReply(*self.submit(code, name, address, timeout, data, priority, flags).result())
+    def line(self, name):
+        return RemoteLine(self, name)
+    def close(self):
+        with self.__lock__:
+            self.__closed__ = True
+        for worker in self.workers:
+            with worker.lock:
+                worker.requests.send_bytes(b'')
+            worker.process.join()
+            worker.collector.join()
+            worker.requests.close()
+            worker.ring.close()
+            worker.ring.unlink()
+    def __collect__(self, worker):
+        while True:
+            if not worker.ready.acquire(timeout=0.5):
+                if not worker.process.is_alive():
+                    break
+                continue
+            data = worker.ring.get()
+            id, code = message.unpack_from(data)
+            with self.__lock__:
+                pending = self.__pending__.pop(id, None)
+            if pending is not None:
+                pending[1].set_result((code, data[message.size:]))
+        with self.__lock__:
+            failed = [id for id, (owner, future) in self.__pending__.items() if owner is worker]
+            futures = [self.__pending__.pop(id)[1] for id in failed]
+        for future in futures:
+            future.set_exception(RuntimeError("Shard worker %s exited" % worker.process.name))
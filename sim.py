@@ -0,0 +1,332 @@
+""" Simulated RS485 bus with ADAM and Kshd emulators for benchmarks and experiments without hardware
+    SimulatedBus delivers requests to emulated devices and schedules their replies
+    according to baud rate, device latency, jitter, byte loss and corruption.
+    SimulatedLine is a Line attached to a SimulatedBus, SimulatedGateway serves the bus
+    over TCP like a TCP/IP to RS485 converter does, so it can be used with SocketLine.
+"""
+from collections import deque
+from datetime import timedelta
+from random import Random
+from socketserver import ThreadingTCPServer, BaseRequestHandler
+from struct import pack, unpack
+from threading import Lock, Thread
+from time import monotonic, monotonic_ns, sleep
+from .line import Line, LineBuffer, total_seconds, deadlineAfter
+from .piv import PivCodec, PivDecoder, BadPivPacket
+
+class AdamEmulator(object):
+    """ ADAM-4000 module speaking ASCII protocol
+        Supported types: 4068 and 4060 relays, 4024 analog output, 4017 analog input, 4053 digital input.
+        State is exposed as relays (bit mask), outputs, inputs (list of values) and digitalInputs (bit mask).
+    """
+    types = ("4068", "4060", "4024", "4017", "4053")
+    def __init__(self, address, type="4068"):
+        assert(type in AdamEmulator.types)
+        self.address = address
+        self.type = type
+        self.relays = 0
+        self.outputs = [0.] * 4
+        self.outputRanges = [0] * 4
+        self.inputs = [0.] * 8
+        self.digitalInputs = 0
+        self.__prefix__ = b"%02X" % address
+        self.__buffer__ = LineBuffer()
+    def receive(self, data, now):
+        """Consumes bytes seen on the bus, returns reply bytes"""
+        self.__buffer__.append(data)
+        rv = []
+        while True:
+            frame = self.__buffer__.readline(b'\r')
+            if frame is None:
+                break
+            reply = self.__handle__(frame)
+            if reply is not None:
+                rv.append(reply + b'\r')
+        return b"".join(rv)
+    def __handle__(self, frame):
+        start = max(frame.rfind(b'$'), frame.rfind(b'#'))
+        if start < 0 or frame[start + 1:start + 3] != self.__prefix__:
+            return None
+        kind, command = frame[start:start + 1], frame[start + 3:]
+        prefix = self.__prefix__
+        invalid = b"?" + prefix
+        if kind == b'$':
+            if command == b'M':
+                return b"!" + prefix + self.type.encode("utf-8")
+            if command == b'6' and self.type in ("4068", "4060"):
+                return b"!%02X00" % self.relays
+            if command == b'6' and self.type == "4053":
+                return b"!%04X00" % self.digitalInputs
+            if command[0:2] == b'7C' and command[3:5] == b'R3' and self.type == "4024":
+                try:
+                    channel, mode = int(command[2:3]), int(command[5:6])
+                except ValueError:
+                    return invalid
+                if channel > 3 or mode > 2:
+                    return invalid
+                self.outputRanges[channel] = mode
+                return b"!" + prefix
+            return invalid
+        if self.type in ("4068", "4060"):
+            count = 8 if self.type == "4068" else 4
+            try:
+                value = int(command[2:4], 16)
+            except ValueError:
+                return invalid
+            if len(command) != 4:
+                return invalid
+            if command[0:2] == b'00':
+                self.relays = value & ((1 << count) - 1)
+                return b">"
+            if command[0:1] == b'1' and command[2:3] == b'0':
+                channel = int(command[1:2], 16)
+                if channel >= count or value > 1:
+                    return invalid
+                self.relays = (self.relays & ~(1 << channel)) | (value << channel)
+                return b">"
+            return invalid
+        if self.type == "4024":
+            if command[0:1] != b'C':
+                return invalid
+            try:
+                channel, value = int(command[1:2], 16), float(command[2:])
+            except ValueError:
+                return invalid
+            if channel > 3:
+                return invalid
+            self.outputs[channel] = value
+            return b">"
+        if self.type == "4017" and command == b"":
+            return b">" + b"".join(b"%+07.3f" % value for value in self.inputs)
+        return invalid
+
+class KshdEmulator(object):
+    """ Kshd stepper motor controller speaking PIV protocol
+        Moves at constant rate: speed maximum for go, 10**6/stepTime steps per second for goWithSpeed.
+        Optional minLimit and maxLimit coordinates stop the motion like limit switches.
+    """
+    def __init__(self, address, identity=b'WS01', minLimit=None, maxLimit=None):
+        self.address = address
+        self.identity = identity
+        self.minLimit = minLimit
+        self.maxLimit = maxLimit
+        self.configuration = b'\x03\x01\x00\x00'
+        self.speed = pack("!HHH", 1000, 6000, 10000)
+        self.__coordinate__ = 0
+        self.__steps__ = 0
+        self.__rate__ = 0.
+        self.__started__ = 0.
+        self.__exactSpeed__ = False
+        self.__decoder__ = PivDecoder()
+    def __done__(self, now):
+        """Returns steps made since move start and whether the move is over"""
+        steps = abs(self.__steps__)
+        done = min(steps, int((now - self.__started__) * self.__rate__))
+        sign = 1 if self.__steps__ > 0 else -1
+        position = self.__coordinate__ + sign * done
+        if self.maxLimit is not None and position >= self.maxLimit and sign > 0:
+            return self.maxLimit - self.__coordinate__, True
+        if self.minLimit is not None and position <= self.minLimit and sign < 0:
+            return self.__coordinate__ - self.minLimit, True
+        return done, done == steps
+    def coordinate(self, now):
+        if not self.__steps__:
+            return self.__coordinate__
+        done, finished = self.__done__(now)
+        sign = 1 if self.__steps__ > 0 else -1
+        if finished:
+            self.__coordinate__ += sign * done
+            self.__steps__ = 0
+            return self.__coordinate__
+        return self.__coordinate__ + sign * done
+    def stepsToGo(self, now):
+        if not self.__steps__:
+            return 0
+        done, finished = self.__done__(now)
+        if finished:
+            self.coordinate(now)
+            return 0
+        return abs(self.__steps__) - done
+    def status(self, now):
+        x = self.coordinate(now)
+        moving = bool(self.__steps__)
+        rv = 2 if moving else 1
+        if self.minLimit is not None and x <= self.minLimit:
+            rv |= 4
+        if self.maxLimit is not None and x >= self.maxLimit:
+            rv |= 8
+        if x == 0:
+            rv |= 16
+        if moving and self.__exactSpeed__:
+            rv |= 32
+        return rv
+    def __move__(self, steps, rate, exactSpeed, now):
+        self.__coordinate__ = self.coordinate(now)
+        self.__steps__ = steps
+        self.__rate__ = rate
+        self.__started__ = now
+        self.__exactSpeed__ = exactSpeed
+    def receive(self, data, now):
+        """Consumes bytes seen on the bus, returns reply frames"""
+        self.__decoder__.feed(data)
+        rv = []
+        while True:
+            try:
+                body = next(self.__decoder__)
+            except StopIteration:
+                break
+            except BadPivPacket:
+                continue
+            if body[0] != self.address:
+                continue
+            reply = self.__command__(bytes(body[1:]), now)
+            if reply is not None:
+                rv.append(PivCodec.encode(self.address, reply))
+        return b"".join(rv)
+    def __command__(self, request, now):
+        code, args = request[0:1], request[1:]
+        if code == b'\x01' and not args:
+            return self.identity
+        if code == b'\x03' and not args:
+            pass
+        elif code == b'\x04' and len(args) == 4:
+            self.__move__(unpack("!i", args)[0], unpack("!HHH", self.speed)[1], False, now)
+        elif code == b'\x06' and len(args) == 4:
+            self.configuration = args
+        elif code == b'\x07' and len(args) == 6:
+            self.speed = args
+        elif code == b'\x08' and not args:
+            self.__coordinate__ = self.coordinate(now)
+            self.__steps__ = 0
+        elif code == b'\x0C' and not args:
+            return pack("!I", self.stepsToGo(now))
+        elif code == b'\x0D' and not args:
+            return self.configuration
+        elif code == b'\x0E' and not args:
+            return self.speed
+        elif code == b'\x11' and len(args) == 8:
+            steps, stepTime = unpack("!iI", args)
+            self.__move__(steps, 1e6 / max(1, stepTime), True, now)
+        elif code == b'\x13' and len(args) == 4:
+            if not self.__steps__:
+                self.__coordinate__ = unpack("!i", args)[0]
+        elif code == b'\x14' and not args:
+            return pack("!i", self.coordinate(now))
+        else:
+            return None
+        return bytes([self.status(now)])
+
+class SimulatedBus(object):
+    """ Half-duplex bus with emulated devices
+        Every device sees every request and replies after latency plus random jitter (timedelta).
+        Transfer time of each byte is characterBits / baudrate, bus carries one transfer at a time.
+        loss and corruption are per byte probabilities of drop and single bit flip, applied both ways.
+    """
+    def __init__(self, devices, baudrate=115200, characterBits=10, latency=timedelta(milliseconds=1), jitter=timedelta(0), loss=0., corruption=0., seed=None):
+        self.devices = list(devices)
+        self.baudrate = baudrate
+        self.characterBits = characterBits
+        self.latency = latency
+        self.jitter = jitter
+        self.loss = loss
+        self.corruption = corruption
+        self.lost = 0
+        self.corrupted = 0
+        self.__random__ = Random(seed)
+        self.__free__ = 0.
+        self.__lock__ = Lock()
+    def characterTime(self):
+        return float(self.characterBits) / self.baudrate
+    def __damage__(self, data):
+        if not self.loss and not self.corruption:
+            return data
+        random = self.__random__
+        rv = bytearray()
+        for b in data:
+            if random.random() < self.loss:
+                self.lost += 1
+                continue
+            if random.random() < self.corruption:
+                self.corrupted += 1
+                b ^= 1 << random.randrange(8)
+            rv.append(b)
+        return bytes(rv)
+    def transmit(self, data, now):
+        """ Sends request at monotonic() time now, returns list of (arrival time, reply bytes) """
+        with self.__lock__:
+            character = self.characterTime()
+            t = max(now, self.__free__) + len(data) * character
+            data = self.__damage__(bytes(data))
+            latency = total_seconds(self.latency)
+            jitter = total_seconds(self.jitter)
+            rv = []
+            for device in self.devices:
+                reply = device.receive(data, t)
+                if not reply:
+                    continue
+                t += latency + self.__random__.uniform(0, jitter) + len(reply) * character
+                reply = self.__damage__(reply)
+                if reply:
+                    rv.append((t, reply))
+            self.__free__ = t
+            return rv
+
+class SimulatedLine(Line):
+    """ Line attached to SimulatedBus
+        Writes don't block, reply bytes become readable once their transfer is over.
+    """
+    def __init__(self, bus, name="sim", highWater=65536):
+        Line.__init__(self, highWater, name)
+        self.bus = bus
+        self.__deliveries__ = deque()
+    def write(self, data):
+        self.bytesWritten += len(data)
+        self.__deliveries__.extend(self.bus.transmit(data, monotonic()))
+    def readWithTimeout(self, timeout):
+        assert(isinstance(timeout, timedelta))
+        self.readUntil(deadlineAfter(timeout))
+    def readUntil(self, deadline):
+        deliveries = self.__deliveries__
+        timeout = max(0., (deadline - monotonic_ns()) / 1e9)
+        if not deliveries:
+            if timeout > 0:
+                sleep(timeout)
+            return
+        wait = deliveries[0][0] - monotonic()
+        if wait > timeout:
+            if timeout > 0:
+                sleep(timeout)
+            return
+        if wait > 0:
+            sleep(wait)
+        now = monotonic()
+        while deliveries and deliveries[0][0] <= now:
+            self.__buffer__.append(deliveries.popleft()[1])
+
+class SimulatedGateway(object):
+    """ TCP/IP to RS485 converter stand-in serving SimulatedBus on localhost
+        Connect with line.SocketLine or line.PersistentSocket to address.
+    """
+    def __init__(self, bus, host="127.0.0.1", port=0):
+        self.bus = bus
+        class Handler(BaseRequestHandler):
+            def handle(self):
+                while True:
+                    data = self.request.recv(4096)
+                    if not data:
+                        return
+                    for t, reply in bus.transmit(data, monotonic()):
+                        wait = t - monotonic()
+                        if wait > 0:
+                            sleep(wait)
+                        self.request.sendall(reply)
+        class Server(ThreadingTCPServer):
+            allow_reuse_address = True
+            daemon_threads = True
+        self.__server__ = Server((host, port), Handler)
+        self.address = self.__server__.server_address
+        self.__thread__ = Thread(target=self.__server__.serve_forever, name="SimulatedGateway", daemon=True)
+        self.__thread__.start()
+    def close(self):
+        self.__server__.shutdown()
+        self.__server__.server_close()
@@ -0,0 +1,14 @@
+""" Makes the checkout importable as rs485 package whatever its directory is called """
+import importlib.util
+import os
+import sys
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+try:
+    import rs485
+except ImportError:
+    spec = importlib.util.spec_from_file_location("rs485", os.path.join(root, "__init__.py"), submodule_search_locations=[root])
+    rs485 = importlib.util.module_from_spec(spec)
+    sys.modules["rs485"] = rs485
+    spec.loader.exec_module(rs485)
@@ -0,0 +1,110 @@
+from datetime import timedelta
+from struct import pack
+from threading import Barrier, Thread
+import pytest
+from rs485.adam import BadModuleType, BadReply
+from rs485.busd import BusClient, BusServer, RemoteAdam4024, RemoteAdam4068, RemotePiv
+from rs485.sim import AdamEmulator, KshdEmulator, SimulatedBus, SimulatedLine
+
+@pytest.fixture
+def bus(tmp_path):
+    devices = [AdamEmulator(1), AdamEmulator(2, "4024")]
+    server = BusServer(str(tmp_path / "bus.sock"), {"sim": SimulatedLine(SimulatedBus(devices))})
+    server.start()
+    client = BusClient(server.path)
+    yield client, devices
+    client.close()
+    server.close()
+
+def test_round_trip(bus):
+    client, devices = bus
+    relays = RemoteAdam4068(client.line("sim"), 1)
+    relays.setChannels([True, False, True, False, False, False, False, True])
+    assert devices[0].relays == 0x85
+    assert relays.query("M") == "4068"
+    RemoteAdam4024(client.line("sim"), 2).setChannelOutputRange(1, 2)
+    assert devices[1].outputRanges[1] == 2
+
+def test_bad_reply_is_rebuilt(bus):
+    client, devices = bus
+    relays = RemoteAdam4068(client.line("sim"), 1)
+    with pytest.raises(BadReply) as error:
+        relays.query("ZZ")
+    assert error.value.request == "$01ZZ"
+    assert error.value.reply == "?01"
+
+def test_bad_module_type(bus):
+    client, devices = bus
+    with pytest.raises(BadModuleType) as error:
+        RemoteAdam4024(client.line("sim"), 1)
+    assert error.value.actual == "4068"
+
+class Counting(object):
+    """Emulator mixin counting requests seen on the bus"""
+    requests = 0
+    def receive(self, data, now):
+        self.requests += 1
+        return super(Counting, self).receive(data, now)
+
+class CountingAdam(Counting, AdamEmulator):
+    pass
+
+class CountingKshd(Counting, KshdEmulator):
+    pass
+
+def concurrently(count, action):
+    """Runs action() from count client threads started at once, returns results or exceptions raised"""
+    barrier = Barrier(count)
+    results = [None] * count
+    def run(i):
+        barrier.wait()
+        try:
+            results[i] = action()
+        except Exception as e:
+            results[i] = e
+    threads = [Thread(target=run, args=(i,)) for i in range(count)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(10)
+    return results
+
+@pytest.fixture
+def slowBus(tmp_path):
+    devices = [CountingAdam(1), CountingKshd(3)]
+    bus = SimulatedBus(devices, latency=timedelta(milliseconds=50))
+    server = BusServer(str(tmp_path / "bus.sock"), {"sim": SimulatedLine(bus)})
+    server.start()
+    client = BusClient(server.path)
+    yield server, client, devices
+    client.close()
+    server.close()
+
+def test_identical_queries_coalesce(slowBus):
+    server, client, devices = slowBus
+    relays = RemoteAdam4068(client.line("sim"), 1)
+    relays.timeout = timedelta(seconds=2)
+    devices[0].requests = 0
+    assert concurrently(8, lambda: relays.query("M")) == ["4068"] * 8
+    assert server.coalesced > 0
+    assert devices[0].requests < 8
+
+def test_writes_are_not_coalesced(slowBus):
+    server, client, devices = slowBus
+    relays = RemoteAdam4068(client.line("sim"), 1)
+    relays.timeout = timedelta(seconds=2)
+    devices[0].requests = 0
+    coalesced = server.coalesced
+    assert concurrently(4, lambda: relays.write("0085")) == [None] * 4
+    assert devices[0].requests == 4
+    assert server.coalesced == coalesced
+
+def test_non_idempotent_piv_queries_are_not_coalesced(slowBus):
+    server, client, devices = slowBus
+    def go():
+        piv = RemotePiv(client.line("sim"))
+        piv.timeout = timedelta(seconds=2)
+        return piv.query(3, b'\x04' + pack("!i", 10), idempotent=False)
+    assert all(isinstance(status, bytes) for status in concurrently(4, go))
+    assert devices[1].requests == 4
+    assert server.coalesced == 0
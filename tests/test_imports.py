@@ -0,0 +1,13 @@
+import os
+from rs485 import bench
+
+def test_entry_points_skip_heavy_imports(tmp_path, monkeypatch):
+    """ bench.importTime() runs "import rs485" in a fresh interpreter, link checkout under that name """
+    os.symlink(bench.os.path.dirname(os.path.abspath(bench.__file__)), tmp_path / "rs485")
+    monkeypatch.setenv("PYTHONPATH", str(tmp_path))
+    bench.benchImports()
+
+def test_lazy_exports():
+    import rs485
+    for name in rs485.__all__:
+        assert getattr(rs485, name) is not None
@@ -0,0 +1,52 @@
+from datetime import timedelta
+import pytest
+from rs485.line import BufferOverflow, LineBuffer, Timeout
+from rs485.adam import AdamModule
+from rs485.sim import AdamEmulator, SimulatedBus, SimulatedLine
+
+def test_buffer_readline():
+    buffer = LineBuffer(8, 64)
+    buffer.append(b"!014068\r!02")
+    assert buffer.readline(b"\r") == b"!014068"
+    assert buffer.readline(b"\r") is None
+    buffer.append(b"4060\r")
+    assert buffer.readline(b"\r") == b"!024060"
+    assert len(buffer) == 0
+
+def test_buffer_resumes_search():
+    buffer = LineBuffer(4, 64)
+    for chunk in (b"ab", b"c\r", b"\nde"):
+        buffer.append(chunk)
+        if chunk != b"\nde":
+            assert buffer.readline(b"\r\n") is None
+    assert buffer.readline(b"\r\n") == b"abc"
+    assert bytes(buffer) == b"de"
+
+def test_buffer_overflow_and_resume():
+    buffer = LineBuffer(4, 16)
+    buffer.append(b"x" * 10)
+    with pytest.raises(BufferOverflow):
+        buffer.append(b"x" * 10)
+    assert len(buffer) == 0
+    buffer.append(b"!014068\r")
+    assert buffer.readline(b"\r") == b"!014068"
+
+def test_poll_many_matches_replies():
+    devices = [AdamEmulator(1, "4068"), AdamEmulator(2, "4017"), AdamEmulator(3, "4053")]
+    line = SimulatedLine(SimulatedBus(devices))
+    modules = [AdamModule(line, address) for address in (3, 1, 2)]
+    missing = AdamModule(line, 9)
+    batch = [(modules[0], "M"), (missing, "M"), (modules[1], "M"), (modules[2], "M"), (modules[1], "M")]
+    arrivals = []
+    results = line.pollMany(batch, timeout=timedelta(milliseconds=50), arrivals=arrivals)
+    assert results[0] == "4053"
+    assert isinstance(results[1], Timeout)
+    assert results[2:] == ["4068", "4017", "4068"]
+    assert arrivals[1] is None
+    assert all(arrivals[i] is not None for i in (0, 2, 3, 4))
+
+def test_poll_many_pipeline_depth():
+    line = SimulatedLine(SimulatedBus([AdamEmulator(address) for address in range(1, 6)]))
+    line.pipelineDepth = 2
+    batch = [(AdamModule(line, address), "M") for address in range(1, 6)]
+    assert line.pollMany(batch, timeout=timedelta(milliseconds=50)) == ["4068"] * 5
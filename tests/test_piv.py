@@ -0,0 +1,62 @@
+import pytest
+from rs485.bench import legacyCalcControl, legacyPivDecode, legacyPivEncode
+from rs485.piv import BadPivPacket, Kshd, Piv
+from rs485.sim import SimulatedBus, SimulatedLine
+
+def outcome(decode, address, data):
+    """Returns decoded payload or BadPivPacket message"""
+    try:
+        return bytes(decode(address, data))
+    except BadPivPacket as e:
+        return e.args[0][0]
+
+def frame(address, payload):
+    return legacyPivEncode(address, payload)[1:-1]
+
+def unescaped(body):
+    """Frame of body and its control sum, shifts are added by hand"""
+    return body + bytes([legacyCalcControl(body)])
+
+@pytest.mark.parametrize("data", [
+    frame(5, b'\x03'),
+    frame(0xAB, bytes(range(0xA8, 0xB0))), # escaped address, payload and control sum
+    frame(5, b'\xac\xac\x02'),
+    b'\x05\xac\x03' + unescaped(b'\x05\xad')[-1:], # shifted value other than start, stop or shift
+    frame(5, b'\x03') + b'\xac', # trailing shift is dropped
+    b'\x05\xac\xab\x00', b'\x05\xac\xac\x00', b'\x05\xac\x56\x00', # invalid shifts
+    frame(5, b'\x03')[:-1] + b'\x00', # bad control sum
+    frame(6, b'\x03'), # wrong address
+    b'', b'\x00', b'\x05', # too short
+    b'\xac\x02', b'\x05\xac', # long enough, but shorter than control sum once unescaped
+])
+def test_decode_matches_legacy(data):
+    piv = Piv(SimulatedLine(SimulatedBus([])))
+    assert outcome(piv.decode, 5, data) == outcome(legacyPivDecode, 5, data)
+
+def test_decode_frame_without_body():
+    """ Intentional difference: a frame unescaping to a lone zero control sum passes the legacy
+        length and control sum checks and fails with IndexError, codec reports it as too short
+    """
+    data = b'\x00\xac'
+    with pytest.raises(IndexError):
+        legacyPivDecode(5, data)
+    assert outcome(Piv(SimulatedLine(SimulatedBus([]))).decode, 5, data) == "Piv packet is too short"
+
+def test_decode_resynchronizes_on_start():
+    """ Intentional difference: codec drops anything up to the last start symbol,
+        such as garbage preceding a frame, legacy decoder treated start symbol as data
+    """
+    data = b'\x01\x02\xaa' + frame(5, b'\x03')
+    assert outcome(legacyPivDecode, 5, data) == "Bad control sum"
+    assert Piv(SimulatedLine(SimulatedBus([]))).decode(5, data) == b'\x03'
+
+def test_status_is_compatible():
+    """Status was a plain object: always true and equal only to itself"""
+    status = Kshd.statuses[0]
+    assert status
+    assert status != 0 and 0 != status
+    assert status == Kshd.statuses[0]
+    assert Kshd.statuses[1] != Kshd.statuses[3]
+    assert int(Kshd.statuses[0x23]) == 0x23
+    assert Kshd.statuses[0x23].moving and not Kshd.statuses[0x23].atPlus
+    assert len({Kshd.statuses[1], Kshd.statuses[1]}) == 1
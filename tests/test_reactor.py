@@ -0,0 +1,38 @@
+from datetime import timedelta
+from rs485.adam import AdamModule
+from rs485.bench import droppingGateway
+from rs485.line import PersistentSocket, SocketLine
+from rs485.reactor import LineReactor
+from rs485.retry import RetryPolicy
+from rs485.sim import AdamEmulator, SimulatedBus, SimulatedGateway
+
+def test_reactor_reads_gateway():
+    gateway = SimulatedGateway(SimulatedBus([AdamEmulator(1), AdamEmulator(2, "4024")]))
+    reactor = LineReactor()
+    try:
+        line = SocketLine(PersistentSocket(gateway.address))
+        reactor.attach(line)
+        for address, type in ((1, "4068"), (2, "4024")):
+            module = AdamModule(line, address)
+            module.timeout = timedelta(seconds=1)
+            assert module.query("M") == type
+    finally:
+        reactor.close()
+        gateway.close()
+
+def test_reactor_reconnect():
+    server = droppingGateway(3)
+    reactor = LineReactor()
+    try:
+        sock = PersistentSocket(server.getsockname(), minBackoff=0., maxBackoff=0.)
+        line = SocketLine(sock)
+        reactor.attach(line)
+        module = AdamModule(line, 1)
+        module.timeout = timedelta(milliseconds=200)
+        module.retryPolicy = RetryPolicy(attempts=5)
+        for i in range(15):
+            assert module.query("M") == "4068"
+        assert sock.reconnects >= 4
+    finally:
+        reactor.close()
+        server.close()
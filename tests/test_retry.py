@@ -0,0 +1,52 @@
+from datetime import timedelta
+import pytest
+from rs485.adam import AdamModule, BadReply
+from rs485.line import DebugLine
+from rs485.retry import RetryPolicy
+from rs485.sim import AdamEmulator, SimulatedBus, SimulatedLine
+
+class StaleEmulator(AdamEmulator):
+    """Answers first request with an error followed by stale replies of another query"""
+    def __init__(self, address):
+        AdamEmulator.__init__(self, address)
+        self.stale = True
+    def receive(self, data, now):
+        reply = AdamEmulator.receive(self, data, now)
+        if reply and self.stale:
+            self.stale = False
+            return b"?%02X\r" % self.address + b"!%02XFFFF\r" % self.address * 3
+        return reply
+
+def module(device):
+    rv = AdamModule(SimulatedLine(SimulatedBus([device])), device.address)
+    rv.timeout = timedelta(milliseconds=50)
+    return rv
+
+def test_retry_discards_stale_replies():
+    adam = module(StaleEmulator(1))
+    adam.retryPolicy = RetryPolicy()
+    assert adam.query("M") == "4068"
+    assert adam.retryPolicy.retries == 1
+    assert adam.query("M") == "4068"
+    assert adam.retryPolicy.retries == 1
+
+def test_no_retry_without_policy():
+    adam = module(StaleEmulator(1))
+    with pytest.raises(BadReply):
+        adam.query("M")
+
+def test_non_idempotent_write_is_sent_once():
+    adam = module(StaleEmulator(1))
+    adam.retryPolicy = RetryPolicy()
+    with pytest.raises(BadReply):
+        adam.write("0001", idempotent=False)
+    assert adam.retryPolicy.retries == 0
+
+def test_retry_through_debug_line():
+    device = StaleEmulator(1)
+    adam = AdamModule(DebugLine(SimulatedLine(SimulatedBus([device]))), 1)
+    adam.timeout = timedelta(milliseconds=50)
+    adam.retryPolicy = RetryPolicy()
+    assert adam.query("M") == "4068"
+    assert adam.retryPolicy.retries == 1
+    assert adam.query("M") == "4068"
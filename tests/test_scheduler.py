@@ -0,0 +1,62 @@
+from datetime import timedelta
+from threading import Event
+import pytest
+from rs485.line import DeadlineExpired
+from rs485.scheduler import LineScheduler
+from rs485.sim import AdamEmulator, SimulatedBus, SimulatedLine
+from rs485.adam import AdamModule
+
+@pytest.fixture
+def line():
+    line = SimulatedLine(SimulatedBus([AdamEmulator(1)]))
+    scheduler = LineScheduler(line)
+    yield line
+    scheduler.close()
+
+def blockWorker(line):
+    """Occupies scheduler worker until returned event is set"""
+    started, release = Event(), Event()
+    def action(line):
+        started.set()
+        release.wait(5)
+    future = line.scheduler.submit(action)
+    assert(started.wait(5))
+    return release, future
+
+def test_priority_order(line):
+    release, blocker = blockWorker(line)
+    order = []
+    futures = [line.scheduler.submit(lambda line, name=name: order.append(name), priority)
+               for name, priority in (("background", LineScheduler.BACKGROUND), ("normal1", LineScheduler.NORMAL),
+                                      ("urgent", LineScheduler.URGENT), ("normal2", LineScheduler.NORMAL))]
+    release.set()
+    for future in [blocker] + futures:
+        future.result(5)
+    assert order == ["urgent", "normal1", "normal2", "background"]
+
+def test_queue_timeout_drops_job(line):
+    release, blocker = blockWorker(line)
+    ran = []
+    expiring = line.scheduler.submit(lambda line: ran.append(1), queueTimeout=timedelta(milliseconds=1))
+    patient = line.scheduler.submit(lambda line: ran.append(2), queueTimeout=timedelta(seconds=5))
+    Event().wait(0.02)
+    release.set()
+    with pytest.raises(DeadlineExpired):
+        expiring.result(5)
+    patient.result(5)
+    assert ran == [2]
+    assert line.scheduler.expired == 1
+
+def test_transact_through_scheduler(line):
+    module = AdamModule(line, 1)
+    assert module.query("M") == "4068"
+    assert line.scheduler.submit(lambda line: module.query("M")).result(5) == "4068"
+    assert line.scheduler.executed == 2
+
+def test_queue_timeout_without_scheduler():
+    line = SimulatedLine(SimulatedBus([AdamEmulator(1)]))
+    module = AdamModule(line, 1)
+    with line.lock:
+        with pytest.raises(DeadlineExpired):
+            module.query("M", queueTimeout=timedelta(milliseconds=10))
+    assert module.query("M", queueTimeout=timedelta(milliseconds=10)) == "4068"
@@ -0,0 +1,110 @@
+import os
+from datetime import timedelta
+from threading import Thread, Timer
+from time import monotonic, sleep
+import pytest
+from rs485.adam import AdamModule, BadReply
+from rs485.line import SerialLine, Timeout, deadlineAfter
+from rs485.sim import AdamEmulator
+
+serial = pytest.importorskip("serial")
+if not hasattr(os, "openpty"):
+    pytest.skip("pseudo terminals are not available", allow_module_level=True)
+
+class FakeSerial(serial.Serial):
+    """Serial port opened on pseudo terminal, counts port reconfigurations"""
+    def __init__(self, *args, **kwargs):
+        self.reconfigurations = 0
+        serial.Serial.__init__(self, *args, **kwargs)
+    def _reconfigure_port(self, *args, **kwargs):
+        self.reconfigurations += 1
+        return serial.Serial._reconfigure_port(self, *args, **kwargs)
+
+@pytest.fixture
+def port():
+    """Yields serial port and descriptor of the other end of it"""
+    master, slave = os.openpty()
+    port = FakeSerial(os.ttyname(slave), baudrate=9600)
+    yield port, master
+    port.close()
+    os.close(slave)
+    os.close(master)
+
+def reply(master, data, delay=0.02):
+    Timer(delay, os.write, (master, data)).start()
+
+def elapsed(action):
+    started = monotonic()
+    action()
+    return monotonic() - started
+
+@pytest.mark.parametrize("data, expected", [
+    (b"!014068\r", 8),
+    (b"?01\r", 8), # error reply shorter than hint
+    (b"\xaa\x05\xac\x00\x01\xab", 5), # escaped PIV reply longer than hint
+    (b"!014068\r", None),
+])
+def test_bulk_read_ends_with_reply(port, data, expected):
+    port, master = port
+    line = SerialLine(port, bulkRead=True)
+    delimiter = data[-1:]
+    reply(master, data)
+    result = []
+    assert elapsed(lambda: result.append(line.readlineUntil(deadlineAfter(timedelta(seconds=2)), delimiter, expected))) < 0.5
+    assert result == [data[:-1]]
+
+def test_bulk_read_reply_in_parts(port):
+    port, master = port
+    line = SerialLine(port, bulkRead=True)
+    reply(master, b"!01")
+    reply(master, b"4068\r!02", 0.05)
+    assert line.readline(timedelta(seconds=2), b"\r", 8) == b"!014068"
+    reply(master, b"4024\r")
+    assert line.readline(timedelta(seconds=2), b"\r", 8) == b"!024024"
+
+def test_bulk_read_configures_port_once(port):
+    port, master = port
+    line = SerialLine(port, bulkRead=True)
+    port.reconfigurations = 0
+    for i in range(3):
+        reply(master, b"!014068\r", 0.005)
+        assert line.readline(timedelta(seconds=1), b"\r", 8) == b"!014068"
+    assert port.reconfigurations == 1
+
+def test_bulk_read_timeout(port):
+    port, master = port
+    line = SerialLine(port, bulkRead=True)
+    reply(master, b"!01")
+    with pytest.raises(Timeout):
+        line.readline(timedelta(milliseconds=100), b"\r", 8)
+
+def test_byte_read(port):
+    port, master = port
+    line = SerialLine(port)
+    reply(master, b"!014068\r!02")
+    assert line.readline(timedelta(seconds=1)) == b"!014068"
+    with pytest.raises(Timeout):
+        line.readline(timedelta(milliseconds=50))
+
+def serve(master, device):
+    """Answers requests written to port with device emulator until port is closed"""
+    def run():
+        while True:
+            try:
+                data = os.read(master, 256)
+            except OSError:
+                return
+            if not data:
+                return
+            sleep(0.005)
+            rv = device.receive(data, monotonic())
+            if rv:
+                os.write(master, rv)
+    Thread(target=run, daemon=True).start()
+
+def test_adam_over_serial(port):
+    port, master = port
+    serve(master, AdamEmulator(1, "4024"))
+    module = AdamModule(SerialLine(port, bulkRead=True, turnaround=timedelta(milliseconds=1)), 1)
+    assert module.query("M") == "4024"
+    assert elapsed(lambda: pytest.raises(BadReply, module.query, "6", replyLength=6)) < 0.5
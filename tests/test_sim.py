@@ -0,0 +1,39 @@
+from datetime import timedelta
+from time import monotonic_ns, sleep
+from rs485.adam import AdamModule
+from rs485.piv import Kshd, Piv
+from rs485.sim import AdamEmulator, KshdEmulator, SimulatedBus, SimulatedLine
+
+def test_adam_emulator():
+    devices = [AdamEmulator(1), AdamEmulator(2, "4024")]
+    line = SimulatedLine(SimulatedBus(devices))
+    assert AdamModule(line, 1).query("M") == "4068"
+    assert AdamModule(line, 2).query("M") == "4024"
+    module = AdamModule(line, 1)
+    module.write("0085")
+    assert devices[0].relays == 0x85
+
+def test_kshd_emulator_moves():
+    device = KshdEmulator(3)
+    kshd = Kshd(Piv(SimulatedLine(SimulatedBus([device]))), 3)
+    kshd.go(3000)
+    assert kshd.getStepsToGo() > 0
+    assert device.stepsToGo(device.__started__ + 1) == 0
+    assert device.coordinate(device.__started__ + 1) == 3000
+
+def test_replies_take_transfer_time():
+    bus = SimulatedBus([AdamEmulator(1)], baudrate=9600, latency=timedelta(0))
+    (arrival, reply), = bus.transmit(b"$01M\r", 0.)
+    assert reply == b"!014068\r"
+    assert abs(arrival - 13 * bus.characterTime()) < 1e-9
+
+def test_read_after_deadline():
+    line = SimulatedLine(SimulatedBus([AdamEmulator(1)], latency=timedelta(milliseconds=20)))
+    line.write(b"$01M\r")
+    line.readUntil(monotonic_ns() - 1000000)
+    assert len(line.__buffer__) == 0
+    line.discard()
+    sleep(0.03)
+    line.discard()
+    assert len(line.__buffer__) == 0
+    assert AdamModule(line, 1).query("M") == "4068"
@@ -0,0 +1,161 @@
+import json
+from collections import deque
+from threading import Lock
+from time import monotonic_ns, time
+from .line import Timeout
+from .adam import AdamError
+from .piv import PivError
+
+class LatencyHistogram(object):
+    """ Log-linear histogram in the spirit of HdrHistogram
+        Values below 2**subBucketBits are counted exactly, larger ones with relative
+        precision of 2**(1-subBucketBits). Memory is fixed, recording is O(1).
+    """
+    def __init__(self, subBucketBits=5, maxValue=1 << 40):
+        self.__subBits__ = subBucketBits
+        self.__sub__ = 1 << subBucketBits
+        self.__half__ = 1 << (subBucketBits - 1)
+        self.maxValue = maxValue
+        self.__counts__ = [0] * (self.__bucket__(maxValue) + 1)
+        self.count = 0
+        self.total = 0
+        self.min = None
+        self.max = None
+    def __bucket__(self, value):
+        if value < self.__sub__:
+            return value
+        shift = value.bit_length() - self.__subBits__
+        return self.__sub__ + (shift - 1) * self.__half__ + (value >> shift) - self.__half__
+    def __bounds__(self, bucket):
+        """Returns lowest and highest value counted in bucket"""
+        if bucket < self.__sub__:
+            return bucket, bucket
+        shift = (bucket - self.__sub__) // self.__half__ + 1
+        mantissa = (bucket - self.__sub__) % self.__half__ + self.__half__
+        return mantissa << shift, ((mantissa + 1) << shift) - 1
+    def record(self, value):
+        value = min(max(int(value), 0), self.maxValue)
+        self.__counts__[self.__bucket__(value)] += 1
+        self.count += 1
+        self.total += value
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+    def mean(self):
+        if not self.count:
+            return None
+        return self.total / self.count
+    def percentile(self, percent):
+        """Returns upper bound of bucket holding given percentile or None if empty"""
+        if not self.count:
+            return None
+        rank = max(1, int(self.count * percent / 100. + 0.5))
+        seen = 0
+        for bucket, count in enumerate(self.__counts__):
+            seen += count
+            if seen >= rank:
+                return min(self.__bounds__(bucket)[1], self.max)
+        return self.max
+    def snapshot(self):
+        return {
+            "count": self.count,
+            "min": self.min,
+            "max": self.max,
+            "mean": self.mean(),
+            "p50": self.percentile(50),
+            "p90": self.percentile(90),
+            "p99": self.percentile(99),
+            "p999": self.percentile(99.9),
+            "buckets": [[self.__bounds__(bucket)[0], count] for bucket, count in enumerate(self.__counts__) if count],
+        }
+
+class ModuleStats(object):
+    """Transaction statistics of single module address"""
+    def __init__(self):
+        self.transactions = 0
+        self.timeouts = 0
+        self.badReplies = 0
+        self.errors = 0
+        self.sent = 0
+        self.received = 0
+        self.latency = LatencyHistogram()
+    def countError(self, error):
+        if isinstance(error, Timeout):
+            self.timeouts += 1
+        elif isinstance(error, (AdamError, PivError)):
+            self.badReplies += 1
+        else:
+            self.errors += 1
+    def snapshot(self):
+        return {
+            "transactions": self.transactions,
+            "timeouts": self.timeouts,
+            "badReplies": self.badReplies,
+            "errors": self.errors,
+            "sent": self.sent,
+            "received": self.received,
+            "latencyNs": self.latency.snapshot(),
+        }
+
+class Tracer(object):
+    """ Collects per module transaction statistics of lines it is attached to
+        Transactions are timed with monotonic clock, last history events are kept with wall clock timestamps.
+        Detached lines pay only for a single attribute check per transaction.
+    """
+    def __init__(self, history=1024):
+        self.events = deque(maxlen=history)
+        self.__stats__ = {}
+        self.__lock__ = Lock()
+    def attach(self, line):
+        line.tracer = self
+    def detach(self, line):
+        if line.tracer is self:
+            line.tracer = None
+    def wrap(self, address, action):
+        """Returns action recording its execution, used by Line.transact()"""
+        def traced(line):
+            sent = line.bytesWritten
+            received = line.bytesRead
+            started = monotonic_ns()
+            error = None
+            try:
+                return action(line)
+            except BaseException as e:
+                error = e
+                raise
+            finally:
+                self.record(line, address, monotonic_ns() - started, line.bytesWritten - sent, line.bytesRead - received, error)
+        return traced
+    def __statsFor__(self, line, address):
+        key = (line.name, address)
+        stats = self.__stats__.get(key)
+        if stats is None:
+            stats = self.__stats__[key] = ModuleStats()
+        return stats
+    def record(self, line, address, latency, sent, received, error=None):
+        with self.__lock__:
+            stats = self.__statsFor__(line, address)
+            stats.transactions += 1
+            stats.sent += sent
+            stats.received += received
+            stats.latency.record(latency)
+            if error is not None:
+                stats.countError(error)
+            self.events.append((time(), line.name, address, latency, sent, received, None if error is None else type(error).__name__))
+    def countError(self, line, address, error):
+        """Counts failure of a single request inside of traced batch transaction"""
+        with self.__lock__:
+            self.__statsFor__(line, address).countError(error)
+    def snapshot(self):
+        """Returns JSON-serializable statistics"""
+        with self.__lock__:
+            modules = [dict(stats.snapshot(), line=name, address=address) for (name, address), stats in self.__stats__.items()]
+            events = [dict(zip(("time", "line", "address", "latencyNs", "sent", "received", "error"), event)) for event in self.events]
+        return {"modules": modules, "events": events}
+    def toJson(self):
+        return json.dumps(self.snapshot(), default=str)
+    def reset(self):
+        with self.__lock__:
+            self.__stats__.clear()
+            self.events.clear()